@@ -5,44 +5,117 @@ import atexit
 import signal
 import gc
 import base64
+import hashlib
+import html
+import logging
+import queue
+import re
+import threading
 import time
 import tempfile
+import string
 import yaml
+import numpy as np
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from src.agentic_rag.tools.custom_tool import DocumentSearchTool
-from src.agentic_rag.crew import build_langgraph_workflow
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+logger = logging.getLogger("pdpa.app")
+
 try:
     from src.agentic_rag.tools.chat_history import ChatHistoryStore
 except Exception:
     ChatHistoryStore = None
+try:
+    from src.agentic_rag.tools.answer_cache import AnswerCacheStore
+except Exception:
+    AnswerCacheStore = None
 
-import base64
-logo_base64 = base64.b64encode(open("assets/Typhoon2.png", "rb").read()).decode()
 
-st.markdown(f"""
+@st.cache_resource
+def _get_deps():
+    """โหลดโมดูลที่หนัก (embedding, Qdrant, LangGraph) ครั้งแรกที่ใช้งานเท่านั้น"""
+    from src.agentic_rag.tools.custom_tool import DocumentSearchTool
+    from src.agentic_rag.crew import build_langgraph_workflow
+    return DocumentSearchTool, build_langgraph_workflow
+
+
+@st.cache_resource
+def _get_security_filter_cls():
+    """นำเข้า SecurityFilter ครั้งเดียวต่อ process"""
+    try:
+        from src.agentic_rag.tools.security_filter import SecurityFilter
+        logger.debug("✅ App: SecurityFilter imported successfully")
+        return SecurityFilter
+    except Exception as e:
+        logger.warning("❌ App: SecurityFilter import failed: %s", e)
+    try:
+        from agentic_rag.tools.security_filter import SecurityFilter
+        logger.debug("✅ App: SecurityFilter imported successfully (fallback)")
+        return SecurityFilter
+    except Exception as e2:
+        logger.warning("❌ App: SecurityFilter import failed (fallback): %s", e2)
+    return None
+
+
+@st.cache_resource
+def _get_history_queue():
+    """สร้างคิวและ thread เบื้องหลังสำหรับบันทึกประวัติแชตลง Qdrant (ครั้งเดียวต่อ process)"""
+    history_queue = queue.Queue()
+
+    def _worker():
+        while True:
+            chat_store, session_id, role, content, ts = history_queue.get()
+            try:
+                chat_store.add_message(session_id=session_id, role=role, content=content, ts=ts)
+            except Exception as e:
+                logger.warning("❌ Chat history write failed (%s): %s", role, e)
+            finally:
+                history_queue.task_done()
+
+    threading.Thread(target=_worker, name="chat-history-writer", daemon=True).start()
+    return history_queue
+
+
+_history_queue = _get_history_queue()
+
+
+def _enqueue_history(role, content):
+    """ส่งข้อความเข้าคิวเพื่อบันทึกลง ChatHistoryStore โดยไม่บล็อก UI"""
+    chat_store = st.session_state.get("chat_store")
+    if chat_store and st.session_state.get("session_id"):
+        _history_queue.put_nowait((chat_store, st.session_state.session_id, role, content, time.time()))
+
+
+def _flush_history_queue(timeout=5.0):
+    """รอให้คิวบันทึกประวัติว่างก่อนปิดโปรแกรม"""
+    deadline = time.monotonic() + timeout
+    while _history_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+_PAGE_CSS_TEMPLATE = string.Template("""
 <style>
 @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600&display=swap');
 
-html, body, [class^='css'] {{
+html, body, [class^='css'] {
     font-family: 'Inter', 'Prompt', sans-serif !important;
-}}
+}
 
-.stApp {{
+.stApp {
     background: linear-gradient(120deg, #181c2f 0%, #232946 100%);
     color: #f3f6fa;
     min-height: 100vh;
-}}
+}
 
 /* 🔹 Sidebar Styling - Hidden */
-section[data-testid="stSidebar"] {{
+section[data-testid="stSidebar"] {
     display: none !important;
-}}
+}
 
 /* 🔹 File Uploader */
-.stFileUploader {{
+.stFileUploader {
     background: #1d1f33;
     border: 1.5px dashed #8f94fb;
     border-radius: 16px;
@@ -50,9 +123,9 @@ section[data-testid="stSidebar"] {{
     text-align: center;
     color: #ccc;
     font-weight: 500;
-}}
+}
 
-.stFileUploader button {{
+.stFileUploader button {
     background: linear-gradient(90deg, #4e54c8, #8f94fb);
     color: white;
     font-weight: bold;
@@ -60,16 +133,16 @@ section[data-testid="stSidebar"] {{
     border-radius: 12px;
     border: none;
     margin-top: 12px;
-}}
+}
 
-.stFileUploader button:hover {{
+.stFileUploader button:hover {
     background: linear-gradient(90deg, #8f94fb, #4e54c8);
     transform: scale(1.03);
     transition: all 0.2s ease-in-out;
-}}
+}
 
 /* 🔹 Reset Chat Button */
-.stButton > button {{
+.stButton > button {
     background: linear-gradient(90deg, #4e54c8, #8f94fb);
     color: white;
     font-weight: bold;
@@ -77,16 +150,16 @@ section[data-testid="stSidebar"] {{
     border-radius: 14px;
     border: none;
     margin-top: 20px;
-}}
+}
 
-.stButton > button:hover {{
+.stButton > button:hover {
     background: linear-gradient(90deg, #8f94fb, #4e54c8);
     transform: scale(1.03);
     box-shadow: 0 4px 14px rgba(78, 84, 200, 0.3);
-}}
+}
 
 /* 🔹 Chat Messages */
-.stChatMessage {{
+.stChatMessage {
     background: rgba(255, 255, 255, 0.05);
     backdrop-filter: blur(10px);
     border-radius: 20px;
@@ -94,23 +167,23 @@ section[data-testid="stSidebar"] {{
     margin: 12px 0;
     border: 1px solid rgba(255,255,255,0.08);
     color: #f3f6fa;
-}}
+}
 
-.stChatMessage[data-testid="user"] {{
+.stChatMessage[data-testid="user"] {
     background: linear-gradient(90deg, #4e54c8, #8f94fb);
     color: white;
     font-weight: 600;
     box-shadow: 0 6px 18px rgba(78, 84, 200, 0.2);
-}}
+}
 
-.stChatMessage[data-testid="assistant"] {{
+.stChatMessage[data-testid="assistant"] {
     background: rgba(36, 40, 59, 0.85);
     border: 1px solid rgba(255,255,255,0.06);
     color: #f3f6fa;
-}}
+}
 
 /* 🔹 Input Bar Floating Bottom */
-.stChatInputContainer {{
+.stChatInputContainer {
     position: fixed;
     left: 0 !important;
     right: 0 !important;
@@ -122,67 +195,67 @@ section[data-testid="stSidebar"] {{
     display: flex;
     justify-content: center;
     width: 100% !important;
-}}
+}
 
-.stChatInputContainer > div {{
+.stChatInputContainer > div {
     width: 100% !important;
     max-width: 1200px !important;
     margin: 0 auto !important;
-}}
+}
 
-.stTextInput {{
+.stTextInput {
     width: 100% !important;
     max-width: 100% !important;
-}}
+}
 
 /* 🔹 Scrollbar */
-::-webkit-scrollbar {{
+::-webkit-scrollbar {
     width: 10px;
     background: #232526;
-}}
+}
 
-::-webkit-scrollbar-thumb {{
+::-webkit-scrollbar-thumb {
     background: #4e54c8;
     border-radius: 8px;
-}}
+}
 
 /* 🔹 Main Logo and Title */
-.main-header {{
+.main-header {
     text-align: center;
     margin: 50px 0 30px 0;
     position: relative;
-}}
+}
 
-.main-logo {{
+.main-logo {
     width: 100px;
     margin-bottom: 16px;
     filter: drop-shadow(0 0 16px rgba(142, 148, 251, 0.5));
-}}
+}
 
-.main-title {{
+.main-title {
     font-size: 2.5rem;
     font-weight: 700;
     color: #ffffff;
     letter-spacing: 1.2px;
     text-shadow: 0 2px 8px rgba(0, 0, 0, 0.3);
-}}
+}
 
 /* 🔹 Main content full width */
-.block-container {{
+.block-container {
     padding-left: 2rem !important;
     padding-right: 2rem !important;
     max-width: 100% !important;
     padding-top: 1rem !important;
-}}
+}
 
 /* 🔹 Adjust main content area when sidebar is hidden */
-.main .block-container {{
+.main .block-container {
     padding-left: 2rem !important;
     padding-right: 2rem !important;
-}}
+}
 
 /* 🔹 Expander Styling for Alternative Answers */
-.streamlit-expanderHeader {{
+.streamlit-expanderHeader {
     background: linear-gradient(90deg, #4e54c8, #8f94fb) !important;
     color: white !important;
     font-weight: 600 !important;
@@ -191,25 +264,25 @@ section[data-testid="stSidebar"] {{
     border: none !important;
     margin: 8px 0 !important;
     transition: all 0.3s ease !important;
-}}
+}
 
-.streamlit-expanderHeader:hover {{
+.streamlit-expanderHeader:hover {
     background: linear-gradient(90deg, #8f94fb, #4e54c8) !important;
     transform: translateY(-2px) !important;
     box-shadow: 0 4px 12px rgba(78, 84, 200, 0.3) !important;
-}}
+}
 
-.streamlit-expanderContent {{
+.streamlit-expanderContent {
     background: rgba(36, 40, 59, 0.6) !important;
     border: 1px solid rgba(255, 255, 255, 0.1) !important;
     border-radius: 12px !important;
     padding: 16px !important;
     margin-top: 8px !important;
     backdrop-filter: blur(10px) !important;
-}}
+}
 
 /* 🔹 Alternative Answer Styling */
-.alternative-answer {{
+.alternative-answer {
     background: rgba(255, 255, 255, 0.03);
     border-left: 3px solid #8f94fb;
     padding: 12px 16px;
@@ -217,20 +290,122 @@ section[data-testid="stSidebar"] {{
     border-radius: 8px;
     border-top-left-radius: 0;
     border-bottom-left-radius: 0;
-}}
+}
+
+/* 🔹 Candidate Scorecard */
+.score-card {
+    background: rgba(255, 255, 255, 0.03);
+    border-left: 3px solid #8f94fb;
+    padding: 12px 16px;
+    margin: 8px 0;
+    border-radius: 8px;
+}
+
+.score-card h4 {
+    margin: 0 0 8px 0;
+}
+
+.score-grid {
+    display: grid;
+    grid-template-columns: repeat(3, 1fr);
+    gap: 8px 16px;
+    margin: 8px 0 12px 0;
+}
+
+.score-label {
+    color: #8f94fb;
+    font-size: 13px;
+}
+
+.score-value {
+    font-size: 20px;
+    font-weight: 600;
+}
+
+.score-notes {
+    display: grid;
+    grid-template-columns: repeat(2, 1fr);
+    gap: 16px;
+    font-size: 14px;
+}
 </style>
 
 <!-- 🔹 Injected Logo + Title -->
 <div class="main-header">
-    <img class="main-logo" src="data:image/png;base64,{logo_base64}" />
+    <img class="main-logo" src="data:image/png;base64,${logo_base64}" />
     <div class="main-title">PDPA Assistant</div>
 </div>
-""", unsafe_allow_html=True)
+""")
+
+
+@st.cache_resource
+def _logo_b64() -> str:
+    """อ่านโลโก้และเข้ารหัส base64 ครั้งเดียวต่อ process"""
+    with open("assets/Typhoon2.png", "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+
+@st.cache_resource
+def _page_css_html() -> str:
+    """สร้าง CSS/HTML ของหน้าพร้อมโลโก้ครั้งเดียว ใช้ซ้ำทุก rerun"""
+    return _PAGE_CSS_TEMPLATE.substitute(logo_base64=_logo_b64())
+
+
+st.markdown(_page_css_html(), unsafe_allow_html=True)
+
+
+# อัปเดต UI ระหว่าง stream ได้ไม่เกิน 1 ครั้งต่อช่วงเวลานี้ (วินาที)
+UI_UPDATE_INTERVAL = 0.05
+
+FALLBACK_ANSWER = "ข้อมูลไม่เพียงพอในการสรุปคำตอบ โปรดระบุคำถามให้ชัดเจนหรืออัปโหลดเอกสารที่เกี่ยวข้องมากขึ้น"
+
+# จำนวนข้อความล่าสุดที่เก็บไว้ใน session_state เพื่อ render ทุกครั้งที่ rerun
+MAX_RENDERED_MESSAGES = 50
+
+# ระยะห่างขั้นต่ำ (วินาที) ระหว่างการทำ garbage collection หลังตอบคำถาม
+GC_INTERVAL = 60.0
+
+
+def _compact_messages():
+    """ตัดข้อความเก่าออกจาก session_state ให้เหลือไม่เกิน MAX_RENDERED_MESSAGES (ข้อความเก่ายังอยู่ใน ChatHistoryStore)"""
+    overflow = len(st.session_state.messages) - MAX_RENDERED_MESSAGES
+    if overflow > 0:
+        # นับเฉพาะข้อความที่ถูกบันทึกลง store เพื่อให้ offset ของการโหลดหน้าก่อนหน้าตรงกับ store
+        archived = sum(1 for m in st.session_state.messages[:overflow] if not m.get("local_only"))
+        del st.session_state.messages[:overflow]
+        st.session_state.archived_message_count = st.session_state.get("archived_message_count", 0) + archived
+        # หน้าที่โหลดไว้จะไม่ต่อเนื่องกับหน้าต่างข้อความแล้ว ให้โหลดใหม่เมื่อผู้ใช้ขอ
+        st.session_state.earlier_messages = []
+
+
+def _persisted_in_window():
+    """จำนวนข้อความในหน้าต่างปัจจุบันที่ถูกส่งไปบันทึกใน ChatHistoryStore"""
+    return sum(1 for m in st.session_state.messages if not m.get("local_only"))
+
+
+PDPA_KEYWORDS = [
+    "PDPA", "Personal Data Protection Act", "คุ้มครองข้อมูลส่วนบุคคล", "พ.ร.บ. คุ้มครองข้อมูลส่วนบุคคล", 
+    "ข้อมูลส่วนบุคคล", "data controller", "data processor", "ผู้ควบคุมข้อมูล", "ผู้ประมวลผลข้อมูล",
+    "สิทธิเจ้าของข้อมูล", "การประมวลผลข้อมูล", "การเก็บรวบรวมข้อมูล", "ฐานทางกฎหมาย"
+]
+_PDPA_KEYWORD_RE = re.compile("|".join(map(re.escape, PDPA_KEYWORDS)), re.IGNORECASE)
+
+# ตรวจเชิงความหมายจากข้อความต้นเอกสารเท่านั้น เมื่อไม่พบคำสำคัญตรงตัว
+PDPA_SEMANTIC_SAMPLE_CHARS = 2000
+PDPA_SEMANTIC_THRESHOLD = 0.55
+
+
+@st.cache_resource
+def _pdpa_keyword_vectors(_embedder):
+    """เข้ารหัสคำสำคัญ PDPA ทั้งหมดเป็นเวกเตอร์ (normalize แล้ว) ครั้งเดียวต่อ process"""
+    vecs = np.asarray(_embedder.encode_batch(PDPA_KEYWORDS), dtype=np.float32)
+    return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
 
 
 def is_pdpa_related(document_tool):
     """
-    Checks if the uploaded file is related to PDPA by searching for PDPA-related terms in the document.
+    Checks if the uploaded file is related to PDPA by searching for PDPA-related terms in the document,
+    falling back to cosine similarity against the PDPA keyword embeddings for paraphrased content.
     
     Args:
         document_tool: The DocumentSearchTool instance initialized with the file
@@ -238,30 +413,62 @@ def is_pdpa_related(document_tool):
     Returns:
         bool: True if the file is likely PDPA-related, False otherwise
     """
-    pdpa_keywords = [
-        "PDPA", "Personal Data Protection Act", "คุ้มครองข้อมูลส่วนบุคคล", "พ.ร.บ. คุ้มครองข้อมูลส่วนบุคคล", 
-        "ข้อมูลส่วนบุคคล", "data controller", "data processor", "ผู้ควบคุมข้อมูล", "ผู้ประมวลผลข้อมูล",
-        "สิทธิเจ้าของข้อมูล", "การประมวลผลข้อมูล", "การเก็บรวบรวมข้อมูล", "ฐานทางกฎหมาย"
-    ]
-    
-    if hasattr(document_tool, 'raw_text') and document_tool.raw_text:
-        text = document_tool.raw_text.lower()
-        for keyword in pdpa_keywords:
-            if keyword.lower() in text:
-                return True
-    
-    return False
+    raw_text = getattr(document_tool, 'raw_text', None)
+    if not raw_text:
+        return False
+    if _PDPA_KEYWORD_RE.search(raw_text) is not None:
+        return True
+
+    embedder = getattr(document_tool, 'embedder', None)
+    if embedder is None or not hasattr(embedder, 'encode_batch'):
+        return False
+    try:
+        key_vecs = _pdpa_keyword_vectors(embedder)
+        doc_vec = np.asarray(embedder.encode(raw_text[:PDPA_SEMANTIC_SAMPLE_CHARS]), dtype=np.float32)
+        doc_vec /= np.linalg.norm(doc_vec) or 1.0
+        return bool((key_vecs @ doc_vec > PDPA_SEMANTIC_THRESHOLD).any())
+    except Exception as e:
+        logger.warning("PDPA semantic check failed: %s", e)
+        return False
 
 
 def create_agents_and_tasks(pdf_tool, use_knowledge_base=True, file_query_mode=False):
     """สร้าง LangGraph workflow ที่ประกอบด้วย agent สำหรับค้นคว้าและสังเคราะห์คำตอบเกี่ยวกับ PDPA โดยใช้เครื่องมือค้นหา PDF/ฐานความรู้เท่านั้น"""
+    _, build_langgraph_workflow = _get_deps()
     workflow = build_langgraph_workflow(pdf_tool=pdf_tool, use_knowledge_base=use_knowledge_base)
     return workflow
 
 
+@st.cache_resource(show_spinner=False)
+def _load_kb_tool(path):
+    """โหลดฐานความรู้ (DocumentSearchTool) ครั้งเดียวต่อ process และใช้ร่วมกันทุกเซสชัน"""
+    if not (os.path.exists(path) and os.listdir(path)):
+        return None
+    DocumentSearchTool, _ = _get_deps()
+    return DocumentSearchTool(file_path=path)
+
+
+@st.cache_resource(show_spinner=False)
+def _load_kb_workflow(kb_tool_id, use_knowledge_base, _kb_tool):
+    """สร้าง workflow ของฐานความรู้ครั้งเดียวต่อ (ฐานความรู้, โหมด) และใช้ร่วมกันทุกเซสชัน"""
+    return create_agents_and_tasks(_kb_tool, use_knowledge_base=use_knowledge_base)
+
+
+def get_kb_workflow(use_knowledge_base=True):
+    """ดึง workflow ที่ผูกกับฐานความรู้ของ process นี้"""
+    kb_tool = st.session_state.knowledge_base_tool
+    return _load_kb_workflow(id(kb_tool), use_knowledge_base, kb_tool)
+
+
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+if "archived_message_count" not in st.session_state:
+    st.session_state.archived_message_count = 0
+
+if "earlier_messages" not in st.session_state:
+    st.session_state.earlier_messages = []
+
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
     try:
@@ -284,7 +491,14 @@ if "chat_store" not in st.session_state:
                     CHAT_STORE_REF = st.session_state.chat_store
                 except Exception:
                     CHAT_STORE_REF = None
-                st.session_state.messages = st.session_state.chat_store.list_messages(st.session_state.session_id)
+                recent = st.session_state.chat_store.list_messages(
+                    st.session_state.session_id, limit=MAX_RENDERED_MESSAGES, order="desc"
+                )
+                recent.reverse()
+                st.session_state.messages = recent
+                st.session_state.archived_message_count = max(
+                    0, st.session_state.chat_store.count_messages(st.session_state.session_id) - len(recent)
+                )
             else:
                 st.session_state.chat_store = None
                 st.info("Chat history disabled. Set QDRANT_URL2 to enable Qdrant-backed history.")
@@ -299,17 +513,33 @@ if "pdf_tool" not in st.session_state:
 
 if "knowledge_base_tool" not in st.session_state:
     knowledge_files = os.path.join("knowledge")
-    if os.path.exists(knowledge_files) and os.listdir(knowledge_files):
+    try:
+        st.session_state.knowledge_base_tool = _load_kb_tool(knowledge_files)
+    except Exception as e:
+        st.error(f"Error loading knowledge base: {str(e)}")
+        st.session_state.knowledge_base_tool = None
+
+if "answer_cache" not in st.session_state:
+    st.session_state.answer_cache = None
+    cache_enabled = os.getenv("RAG_ANSWER_CACHE", "1").lower() in ("1", "true", "yes", "y")
+    qdrant_url = os.getenv("QDRANT_URL2")
+    if AnswerCacheStore is not None and cache_enabled and qdrant_url:
         try:
-            st.session_state.knowledge_base_tool = DocumentSearchTool(file_path=knowledge_files)
+            st.session_state.answer_cache = AnswerCacheStore(
+                collection_name="rag_answer_cache",
+                qdrant_url=qdrant_url,
+                qdrant_api_key=os.getenv("QDRANT_API_KEY2"),
+                embedder=getattr(st.session_state.knowledge_base_tool, "embedder", None),
+                threshold=float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.92")),
+                ttl=float(os.getenv("RAG_ANSWER_CACHE_TTL", str(7 * 24 * 3600))),
+                max_entries=int(os.getenv("RAG_ANSWER_CACHE_MAX_ENTRIES", "5000")),
+            )
         except Exception as e:
-            st.error(f"Error loading knowledge base: {str(e)}")
-            st.session_state.knowledge_base_tool = None
-    else:
-        st.session_state.knowledge_base_tool = None
+            logger.warning("Answer cache unavailable: %s", e)
 
 if "langgraph_workflow" not in st.session_state:
-    st.session_state.langgraph_workflow = build_langgraph_workflow()
+    st.session_state.langgraph_workflow = get_kb_workflow(use_knowledge_base=True)
+    st.session_state._workflow_mode = "kb"
 
 if "using_uploaded_file" not in st.session_state:
     st.session_state.using_uploaded_file = False
@@ -317,7 +547,16 @@ if "using_uploaded_file" not in st.session_state:
 if "is_pdpa_related" not in st.session_state:
     st.session_state.is_pdpa_related = False
 
-def build_conversation_context(messages, max_turns=3):
+if "security_filter" not in st.session_state:
+    st.session_state.security_filter = None
+    _SecurityFilter = _get_security_filter_cls()
+    if _SecurityFilter is not None:
+        try:
+            st.session_state.security_filter = _SecurityFilter()
+        except Exception as e:
+            logger.warning("❌ SecurityFilter init error: %s", e)
+
+def build_conversation_context(messages, max_turns=3, max_chars=4000):
     """รวมประวัติการสนทนาล่าสุดเพื่อให้บริบทเพิ่มเติม"""
     if not messages:
         return ""
@@ -326,37 +565,40 @@ def build_conversation_context(messages, max_turns=3):
     recent_messages = messages[start_idx:]
     
     context = []
-    for msg in recent_messages:
+    char_count = 0
+    for msg in reversed(recent_messages):
         role_prefix = "ผู้ใช้: " if msg["role"] == "user" else "ผู้ช่วย: "
-        context.append(f"{role_prefix}{msg['content']}")
+        line = f"{role_prefix}{msg['content']}"
+        if char_count + len(line) > max_chars:
+            break
+        context.append(line)
+        char_count += len(line)
+    context.reverse()
     
     return "\n".join(context)
 
-def build_conversation_context_from_store(chat_store, session_id, max_turns=3):
-    """สร้างบริบทการสนทนาจาก ChatHistoryStore"""
-    if not chat_store or not session_id:
-        return ""
-    
-    try:
-        return chat_store.get_conversation_context(session_id, max_turns=max_turns, max_chars=4000)
-    except Exception as e:
-        print(f"Error building conversation context from store: {e}")
-        return ""
+def get_conversation_context(max_turns=3):
+    """ดึงบริบทการสนทนาจาก session_state"""
+    return build_conversation_context(st.session_state.messages, max_turns=max_turns)
 
 def reset_chat():
     """ล้างประวัติการสนทนา"""
+    _flush_history_queue()
     try:
         if st.session_state.get("chat_store") and st.session_state.get("session_id"):
             st.session_state.chat_store.reset_session(st.session_state.session_id)
     except Exception as e:
         st.warning(f"ไม่สามารถล้างแชตบน Qdrant ได้: {e}")
     st.session_state.messages = []
-    perform_periodic_gc()
+    st.session_state.archived_message_count = 0
+    st.session_state.earlier_messages = []
+    perform_periodic_gc(full=True)
 
 
 
 def _cleanup_on_exit():
 
+    _flush_history_queue()
     try:
         mode = os.getenv("CHAT_HISTORY_CLEANUP_MODE", "session").lower()
         chat_store = globals().get("CHAT_STORE_REF")
@@ -368,6 +610,7 @@ def _cleanup_on_exit():
                 chat_store.reset_session(session_id)
     except Exception:
         pass
+    gc.collect()
 
 
 def _signal_handler(signum, frame):
@@ -382,22 +625,26 @@ try:
 except Exception:
     pass
 
-def perform_periodic_gc():
-    """ทำ garbage collection เพื่อลดการใช้หน่วยความจำ"""
+def perform_periodic_gc(full=False):
+    """ทำ garbage collection เพื่อลดการใช้หน่วยความจำ (รอบปกติเก็บเฉพาะ generation อายุน้อย และไม่เกินทุก GC_INTERVAL วินาที)"""
     try:
+        now = time.monotonic()
+        if not full and now - st.session_state.get("_last_gc", 0.0) < GC_INTERVAL:
+            return
+        st.session_state._last_gc = now
         if st.session_state.pdf_tool and hasattr(st.session_state.pdf_tool, "_perform_gc"):
             st.session_state.pdf_tool._perform_gc()
-        gc.collect()
+        if full:
+            gc.collect()
+        else:
+            gc.collect(generation=1)
     except Exception as e:
         st.error(f"Error during garbage collection: {str(e)}")
 
-def display_pdf(file_bytes: bytes, file_name: str):
-    """แสดงไฟล์ PDF ใน iframe"""
-    base64_pdf = base64.b64encode(file_bytes).decode("utf-8")
-    pdf_display = f"""
+_PDF_IFRAME_TEMPLATE = string.Template("""
     <div style="display: flex; justify-content: center; margin: 20px 0;">
         <iframe 
-            src="data:application/pdf;base64,{base64_pdf}" 
+            src="data:application/pdf;base64,${b64}" 
             width="100%" 
             height="600px" 
             style="border: 1px solid rgba(255,255,255,0.1); border-radius: 12px; box-shadow: 0 4px 30px rgba(0,0,0,0.1);"
@@ -405,24 +652,64 @@ def display_pdf(file_bytes: bytes, file_name: str):
         >
         </iframe>
     </div>
-    """
+    """)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _pdf_b64(digest: str, _file_bytes: bytes) -> str:
+    """เข้ารหัส base64 ของไฟล์ PDF โดยใช้ digest ของไฟล์เป็นคีย์แคช"""
+    return base64.b64encode(_file_bytes).decode("utf-8")
+
+
+def display_pdf(file_bytes: bytes, file_name: str):
+    """แสดงไฟล์ PDF ใน iframe"""
+    digest = hashlib.blake2b(file_bytes, digest_size=8).hexdigest()
+    pdf_display = _PDF_IFRAME_TEMPLATE.substitute(b64=_pdf_b64(digest, file_bytes))
     st.markdown(f"<h3 style='text-align: center; margin-bottom: 16px; color: #fff;'>รายละเอียดเอกสาร: {file_name}</h3>", unsafe_allow_html=True)
     st.markdown(pdf_display, unsafe_allow_html=True)
 
 
-if st.session_state.langgraph_workflow is None or st.session_state.using_uploaded_file:
+# โหมดของ workflow: "kb" (ฐานความรู้) หรือ "uploaded" (ไฟล์ที่ผู้ใช้อัปโหลด) สร้างใหม่เฉพาะตอนเปลี่ยนโหมด
+if st.session_state.using_uploaded_file:
+    st.session_state._workflow_mode = "uploaded"
+desired_workflow_mode = "kb"
+if st.session_state.langgraph_workflow is None or st.session_state.get("_workflow_mode") != desired_workflow_mode:
     if st.session_state.pdf_tool is not None:
         if hasattr(st.session_state.pdf_tool, "release_resources"):
             st.session_state.pdf_tool.release_resources()
         st.session_state.pdf_tool = None
-    st.session_state.langgraph_workflow = create_agents_and_tasks(
-        st.session_state.knowledge_base_tool,
-        use_knowledge_base=True
-    )
+    st.session_state.langgraph_workflow = get_kb_workflow(use_knowledge_base=True)
+    st.session_state._workflow_mode = desired_workflow_mode
     st.session_state.using_uploaded_file = False
     st.session_state.is_pdpa_related = True
 
 
+if st.session_state.archived_message_count:
+    with st.expander(f"ข้อความก่อนหน้า ({st.session_state.archived_message_count})", expanded=False):
+        if st.session_state.get("chat_store") and st.session_state.get("session_id"):
+            earlier = st.session_state.earlier_messages
+            remaining = st.session_state.archived_message_count - len(earlier)
+            # ดึงจาก Qdrant ทีละหน้าเฉพาะเมื่อผู้ใช้กดโหลดเท่านั้น
+            if remaining > 0 and st.button("โหลดข้อความก่อนหน้าเพิ่ม", key="load_earlier_messages"):
+                # รอให้ข้อความที่อยู่ในคิวถูกเขียนก่อน ไม่เช่นนั้น offset จะข้ามข้อความเก่าไป
+                _flush_history_queue()
+                try:
+                    page = st.session_state.chat_store.list_messages(
+                        st.session_state.session_id,
+                        limit=min(MAX_RENDERED_MESSAGES, remaining),
+                        order="desc",
+                        offset=_persisted_in_window() + len(earlier),
+                    )
+                    page.reverse()
+                    earlier[:0] = page
+                except Exception as e:
+                    st.warning(f"ไม่สามารถโหลดข้อความก่อนหน้าได้: {e}")
+            for message in earlier:
+                with st.chat_message(message["role"], avatar="👤" if message["role"] == "user" else None):
+                    st.markdown(message["content"])
+        else:
+            st.caption("ข้อความก่อนหน้าไม่ได้ถูกบันทึกไว้ (ปิดใช้งานประวัติแชต)")
+
 for message in st.session_state.messages:
     with st.chat_message(message["role"], avatar="👤" if message["role"] == "user" else None):
         st.markdown(message["content"])
@@ -431,133 +718,128 @@ for message in st.session_state.messages:
 prompt = st.chat_input("พิมพ์คำถามเกี่ยวกับ PDPA ของคุณ...")
 
 if prompt:
-    print(f"🔍 App: Processing prompt: {prompt}")
+    logger.debug("🔍 App: Processing prompt: %s", prompt)
     
     raw_prompt = prompt
 
-    _SecurityFilter = None
-    try:
-        from src.agentic_rag.tools.security_filter import SecurityFilter as _SecurityFilter
-        print("✅ App: SecurityFilter imported successfully")
-    except Exception as e:
-        print(f"❌ App: SecurityFilter import failed: {e}")
+    _ui_sf = st.session_state.get("security_filter")
+    if _ui_sf is not None:
         try:
-            from agentic_rag.tools.security_filter import SecurityFilter as _SecurityFilter
-            print("✅ App: SecurityFilter imported successfully (fallback)")
-        except Exception as e2:
-            print(f"❌ App: SecurityFilter import failed (fallback): {e2}")
-            _SecurityFilter = None
-    if _SecurityFilter is not None:
-        try:
-            print(f"🔍 SecurityFilter: Processing prompt: {prompt}")
-            _ui_sf = _SecurityFilter()
-            _ui_filter = _ui_sf.filter_user_input(prompt or "")
-            print(f"🔍 SecurityFilter result: {_ui_filter}")
+            logger.debug("🔍 SecurityFilter: Processing prompt: %s", prompt)
+            if _ui_sf.is_suspicious(prompt or ""):
+                _ui_filter = _ui_sf.filter_user_input(prompt or "")
+            else:
+                # ข้อความทั่วไปผ่านได้ทันที refine_question_node ใน workflow จะตรวจหัวข้อ PDPA ด้วย filter เต็มอีกครั้ง
+                _ui_filter = {"should_respond": True}
+            logger.debug("🔍 SecurityFilter result: %s", _ui_filter)
             
             if not _ui_filter.get("should_respond", True):
-                print("🔴 SecurityFilter: BLOCKING prompt")
+                logger.debug("🔴 SecurityFilter: BLOCKING prompt")
                 with st.chat_message("user", avatar="👤"):
                     st.markdown(raw_prompt)
                 with st.chat_message("assistant"):
                     st.markdown(_ui_filter.get("response_message") or "ตรวจพบเนื้อหาไม่เหมาะสมในคำถาม ⚠️ กรุณาพิมพ์ใหม่โดยใช้ถ้อยคำที่สุภาพ")
-                st.session_state.messages.append({"role": "assistant", "content": _ui_filter.get("response_message") or "ตรวจพบเนื้อหาไม่เหมาะสมในคำถาม ⚠️ กรุณาพิมพ์ใหม่โดยใช้ถ้อยคำที่สุภาพ"})
+                # คำเตือนนี้ไม่ถูกบันทึกลง store จึงไม่นับใน offset ของการโหลดข้อความก่อนหน้า
+                st.session_state.messages.append({"role": "assistant", "content": _ui_filter.get("response_message") or "ตรวจพบเนื้อหาไม่เหมาะสมในคำถาม ⚠️ กรุณาพิมพ์ใหม่โดยใช้ถ้อยคำที่สุภาพ", "local_only": True})
+                _compact_messages()
                 prompt = None
             else:
-                print("✅ SecurityFilter: ALLOWING prompt")
+                logger.debug("✅ SecurityFilter: ALLOWING prompt")
         except Exception as e:
-            print(f"❌ SecurityFilter error: {e}")
+            logger.exception("❌ SecurityFilter error: %s", e)
             st.error(f"SecurityFilter error: {e}")
             pass
     else:
-        print("❌ SecurityFilter: Not available")
+        logger.warning("❌ SecurityFilter: Not available")
 
 if prompt:
 
     st.session_state.messages.append({"role": "user", "content": raw_prompt})
     try:
-        if st.session_state.get("chat_store"):
-            st.session_state.chat_store.add_message(
-                session_id=st.session_state.session_id,
-                role="user",
-                content=raw_prompt,
-            )
+        _enqueue_history("user", raw_prompt)
     except Exception as e:
         st.warning(f"บันทึกประวัติผู้ใช้ไม่สำเร็จ: {e}")
     with st.chat_message("user", avatar="👤"):
         st.markdown(raw_prompt)
 
-    if st.session_state.get("chat_store") and st.session_state.get("session_id"):
-        conversation_context = build_conversation_context_from_store(
-            st.session_state.chat_store, 
-            st.session_state.session_id, 
-            max_turns=3
-        )
-    else:
-        conversation_context = build_conversation_context(st.session_state.messages)
+    conversation_context = get_conversation_context(max_turns=3)
 
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
-        full_response = ""
         start_time = time.time()
         
         with st.spinner("กำลังประมวลผล..."):
-            print("\n" + "="*50)
-            print(f"User Query: {prompt}")
-            print(f"Conversation Context: {conversation_context[:200]}...")
-            print("="*50 + "\n")
-            print("🚀 LangGraph is kicking off the process...")
-            conversation_history = f"Previous conversation:\n{conversation_context}\n\nNew question:"
-            inputs = {"query": prompt, "context": conversation_history}
-            stream = st.session_state.langgraph_workflow.stream(inputs, stream_mode="values")
-            progress_placeholder = st.empty()
-            progress_log = []
-            result = None
-            last_with_answer = None
-            for chunk in stream:
-                result = chunk
-                if "progress_log" in chunk and chunk["progress_log"]:
-                    progress_log = chunk["progress_log"]
-                    progress_placeholder.markdown(
-                        "<div style='color: #888; opacity: 0.7; font-size: 0.92em;'>"
-                        + "<br>".join([f"• {step}" for step in progress_log])
-                        + "</div>", unsafe_allow_html=True
-                    )
-                if ("response" in chunk and chunk["response"]) or ("candidates" in chunk and chunk["candidates"]):
-                    last_with_answer = chunk
-            progress_placeholder.empty()
-            if last_with_answer is not None:
-                result = last_with_answer
-            print("\n" + "="*50)
-            print("✅ LangGraph process finished.")
-            print(f"🏁 Final Result: {result}")
-            print("="*50 + "\n")
-            def _extract_best_answer(res):
+            answer_cache = st.session_state.get("answer_cache")
+            cached_result = None
+            cache_vector = None
+            # ใช้แคชเฉพาะคำถามแรกของเซสชัน เพราะคำถามต่อเนื่องขึ้นกับบริบทก่อนหน้า
+            is_standalone_question = len(st.session_state.messages) <= 1
+            if answer_cache is not None and is_standalone_question:
                 try:
-                    if not isinstance(res, dict):
-                        return ""
-                    for key in ["response", "best_answer"]:
-                        val = res.get(key)
-                        if isinstance(val, str) and val.strip():
-                            return val.strip()
-                    for key in ["ranked", "candidates"]:
-                        arr = res.get(key)
-                        if isinstance(arr, list) and arr:
-                            first_val = arr[0]
-                            if isinstance(first_val, str) and first_val.strip():
-                                return first_val.strip()
-                    return ""
-                except Exception:
-                    return ""
-            full_response = _extract_best_answer(result)
-            if not full_response:
-                full_response = "ข้อมูลไม่เพียงพอในการสรุปคำตอบ โปรดระบุคำถามให้ชัดเจนหรืออัปโหลดเอกสารที่เกี่ยวข้องมากขึ้น"
+                    cached_result, cache_vector = answer_cache.lookup(prompt)
+                except Exception as e:
+                    logger.warning("Answer cache lookup failed: %s", e)
+            if cached_result is not None:
+                logger.debug("⚡ Answer cache hit")
+                result = cached_result
+            else:
+                logger.debug("User Query: %s", prompt)
+                logger.debug("Conversation Context: %s...", conversation_context[:200])
+                logger.debug("🚀 LangGraph is kicking off the process...")
+                conversation_history = f"Previous conversation:\n{conversation_context}\n\nNew question:"
+                inputs = {"query": prompt, "context": conversation_history}
+                stream = st.session_state.langgraph_workflow.stream(inputs, stream_mode=["values", "custom"])
+                progress_placeholder = st.empty()
+                progress_log = []
+                result = None
+                last_with_answer = None
+                last_ui_update = 0.0
+                prev_log_len = 0
+                streamed_answer = ""
+                last_token_update = 0.0
+                for mode, chunk in stream:
+                    if mode == "custom":
+                        # ระหว่าง stream แสดงเป็นข้อความธรรมดา แล้วค่อย render markdown ครั้งเดียวตอนจบ
+                        streamed_answer += chunk.get("token", "")
+                        now = time.monotonic()
+                        if now - last_token_update >= UI_UPDATE_INTERVAL:
+                            last_token_update = now
+                            message_placeholder.markdown(
+                                "<span style='white-space: pre-wrap;'>" + html.escape(streamed_answer) + "▌</span>",
+                                unsafe_allow_html=True
+                            )
+                        continue
+                    result = chunk
+                    if "progress_log" in chunk and chunk["progress_log"]:
+                        progress_log = chunk["progress_log"]
+                        now = time.monotonic()
+                        if len(progress_log) != prev_log_len and now - last_ui_update >= UI_UPDATE_INTERVAL:
+                            last_ui_update = now
+                            prev_log_len = len(progress_log)
+                            progress_placeholder.markdown(
+                                "<div style='color: #888; opacity: 0.7; font-size: 0.92em;'>"
+                                + "<br>".join("• " + step for step in progress_log)
+                                + "</div>", unsafe_allow_html=True
+                            )
+                    if ("response" in chunk and chunk["response"]) or ("candidates" in chunk and chunk["candidates"]):
+                        last_with_answer = chunk
+                progress_placeholder.empty()
+                if last_with_answer is not None:
+                    result = last_with_answer
+                logger.debug("✅ LangGraph process finished.")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("🏁 Final Result: %r", result)
+                if cache_vector is not None and isinstance(result, dict) and not result.get("blocked"):
+                    try:
+                        answer_cache.store(cache_vector, prompt, result)
+                    except Exception as e:
+                        logger.warning("Answer cache store failed: %s", e)
         
         processing_time = time.time() - start_time
         
-        best_answer = full_response
-        if "candidates" in result and len(result["candidates"]) > 0:
-            if isinstance(result["candidates"][0], str) and result["candidates"][0].strip():
-                best_answer = result["candidates"][0].strip()
+        if not isinstance(result, dict):
+            result = {}
+        best_answer = result.get("best_answer") or FALLBACK_ANSWER
         
         if "progress_log" in result and result["progress_log"]:
             with st.expander("🛠️ ขั้นตอนการคิด/ทำงานของ Agent (คลิกเพื่อดู)", expanded=False):
@@ -595,12 +877,6 @@ if prompt:
             </div>
             """, unsafe_allow_html=True)
         
-        lines = best_answer.split('\n') if isinstance(best_answer, str) else [str(best_answer)]
-        for i, line in enumerate(lines):
-            full_response_so_far = '\n'.join(lines[:i+1])
-            message_placeholder.markdown(full_response_so_far + "▌")
-            time.sleep(0.05)  
-        
         message_placeholder.markdown(best_answer)
         
         if "search_metadata" in result and result["search_metadata"]:
@@ -718,37 +994,32 @@ if prompt:
                             score_color = "🔴"
                             rank_emoji = "🥉"
                         
-                        with st.container():
-                            st.markdown(f"#### {rank_emoji} คำตอบอันดับที่ {rank} - คะแนน: {scores['overall_score']:.1f}/100 {score_color}")
-                            
-                            st.markdown("**📊 คะแนนรายละเอียด:**")
-                            
-                            col1, col2, col3 = st.columns(3)
-                            with col1:
-                                st.metric("ความเกี่ยวข้อง", f"{scores['relevance']}/100")
-                                st.metric("ความครบถ้วน", f"{scores['completeness']}/100")
-                            with col2:
-                                st.metric("ความถูกต้อง", f"{scores['accuracy']}/100")
-                                st.metric("ความชัดเจน", f"{scores['clarity']}/100")
-                            with col3:
-                                st.metric("การอ้างอิง", f"{scores['legal_citation']}/100")
-                                st.metric("คะแนนรวม", f"{scores['overall_score']:.1f}/100")
-                            
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                st.markdown("**✅ จุดเด่น:**")
-                                for strength in scores.get('strengths', ['ไม่มีข้อมูล']):
-                                    st.markdown(f"• {strength}")
-                            
-                            with col2:
-                                st.markdown("**⚠️ จุดที่ควรปรับปรุง:**")
-                                for weakness in scores.get('weaknesses', ['ไม่มีข้อมูล']):
-                                    st.markdown(f"• {weakness}")
-                            
-                            st.markdown("**📝 คำตอบ:**")
-                            st.markdown(answer)
-                            
-                            st.markdown("---")  
+                        score_items = "".join(
+                            f"<div><div class='score-label'>{html.escape(label)}</div><div class='score-value'>{html.escape(str(value))}/100</div></div>"
+                            for label, value in (
+                                ("ความเกี่ยวข้อง", scores['relevance']),
+                                ("ความถูกต้อง", scores['accuracy']),
+                                ("การอ้างอิง", scores['legal_citation']),
+                                ("ความครบถ้วน", scores['completeness']),
+                                ("ความชัดเจน", scores['clarity']),
+                                ("คะแนนรวม", f"{scores['overall_score']:.1f}"),
+                            )
+                        )
+                        strengths = "<br>".join("• " + html.escape(str(x)) for x in scores.get('strengths', ['ไม่มีข้อมูล']))
+                        weaknesses = "<br>".join("• " + html.escape(str(x)) for x in scores.get('weaknesses', ['ไม่มีข้อมูล']))
+                        # การ์ดคะแนนเป็น HTML หนึ่งก้อน (ค่าจากโมเดลถูก escape) ส่วนคำตอบแสดงแยกโดยไม่อนุญาต HTML
+                        st.markdown(
+                            f"<div class='score-card'>"
+                            f"<h4>{rank_emoji} คำตอบอันดับที่ {html.escape(str(rank))} - คะแนน: {scores['overall_score']:.1f}/100 {score_color}</h4>"
+                            f"<b>📊 คะแนนรายละเอียด:</b>"
+                            f"<div class='score-grid'>{score_items}</div>"
+                            f"<div class='score-notes'>"
+                            f"<div><b>✅ จุดเด่น:</b><br>{strengths}</div>"
+                            f"<div><b>⚠️ จุดที่ควรปรับปรุง:</b><br>{weaknesses}</div>"
+                            f"</div></div>",
+                            unsafe_allow_html=True
+                        )
+                        st.markdown(f"**📝 คำตอบ:**\n\n{answer}\n\n---")
                 else:
                     st.markdown("---")
                     st.markdown("### 💡 คำตอบอื่นๆ")
@@ -758,13 +1029,9 @@ if prompt:
                         st.markdown("---")
     
     st.session_state.messages.append({"role": "assistant", "content": best_answer})
+    _compact_messages()
     try:
-        if st.session_state.get("chat_store"):
-            st.session_state.chat_store.add_message(
-                session_id=st.session_state.session_id,
-                role="assistant",
-                content=best_answer,
-            )
+        _enqueue_history("assistant", best_answer)
     except Exception as e:
         st.warning(f"บันทึกประวัติผู้ช่วยไม่สำเร็จ: {e}")
     
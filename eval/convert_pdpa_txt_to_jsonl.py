@@ -1,71 +1,123 @@
 from __future__ import annotations
 
 import argparse
+import itertools
 import json
+import mmap
+import os
 import re
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps_line(entry: Dict[str, str]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(entry) + b"\n"
+    return (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+_RE_QA_HEADER = re.compile(r"([QA])(\d+)(?:\s+|\.)")
+_SEP_CHARS = "=-_~"
+_HEADER_LEADS = frozenset("QqAa")
+_WRITE_CHUNK_BYTES = 64 * 1024
 
 
 def _normalize_whitespace(text: str) -> str:
-    text = re.sub(r"\s+", " ", text.strip())
-    return text
+    return " ".join(text.split())
 
 
 def _preprocess_text(raw: str) -> str:
     text = raw.replace("\ufeff", "")
-    text = re.sub(r"\r\n?", "\n", text)
-    text = re.sub(r"Q(\d+)\s+", r"Q\1: ", text)
-    text = re.sub(r"A(\d+)\s+", r"A\1: ", text)
-    text = re.sub(r"Q(\d+)\.", r"Q\1: ", text)
-    text = re.sub(r"A(\d+)\.", r"A\1: ", text)
-    text = re.sub(r"–", "-", text)
+    text = _RE_QA_HEADER.sub(r"\1\2: ", text)
+    text = text.replace("–", "-")
     return text
 
 
-def _tokenize(text: str) -> List[Tuple[str, str, str]]:
-    question_pattern = re.compile(r"^(Q\d*(?:\.\d+)?)[:\-]?\s*(.*)$", re.IGNORECASE)
-    answer_pattern = re.compile(r"^(A\d*(?:\.\d+)?)[:\-]?\s*(.*)$", re.IGNORECASE)
+def _label_base(label: str) -> str:
+    # "Q3.2" -> "3.2"; labels without a number share the "__default__" base.
+    if label[1:2].isdecimal():
+        return label[1:]
+    return "__default__"
+
 
-    tokens: List[Tuple[str, str, str]] = []
+def _is_skippable_line(line: str) -> bool:
+    # Separator rules ("=====", "-~-") and bare numbers ("12", "3.").
+    if not line.strip(_SEP_CHARS):
+        return True
+    digits = line[:-1] if line[-1] == "." else line
+    return digits.isdecimal()
+
+
+def _parse_qa_header(line: str) -> Tuple[str, str, str] | None:
+    # Hand-rolled equivalent of ^([QA]\d*(?:\.\d+)?)[:\-]?\s*(.*)$ (case-insensitive).
+    kind = line[0]
+    if kind == "q" or kind == "Q":
+        kind = "Q"
+    elif kind == "a" or kind == "A":
+        kind = "A"
+    else:
+        return None
+    n = len(line)
+    i = 1
+    while i < n and line[i].isdecimal():
+        i += 1
+    if i + 1 < n and line[i] == "." and line[i + 1].isdecimal():
+        i += 2
+        while i < n and line[i].isdecimal():
+            i += 1
+    label = line[:i].upper()
+    if i < n and (line[i] == ":" or line[i] == "-"):
+        i += 1
+    while i < n and line[i].isspace():
+        i += 1
+    return kind, label, line[i:]
+
+
+def _tokenize(text: str) -> List[Tuple[str, str, str, str]]:
+    tokens: List[Tuple[str, str, str, str]] = []
     current_kind: str | None = None
     current_label: str | None = None
+    current_base: str | None = None
     buffer: List[str] = []
 
     def flush() -> None:
-        nonlocal current_kind, current_label, buffer
+        nonlocal current_kind, current_label, current_base, buffer
         if current_kind and buffer:
             text_value = _normalize_whitespace(" ".join(buffer))
             if text_value:
-                tokens.append((current_kind, current_label or current_kind, text_value))
+                tokens.append((current_kind, current_label or current_kind, current_base, text_value))
         current_kind = None
         current_label = None
+        current_base = None
         buffer = []
 
-    for raw_line in text.split("\n"):
+    for raw_line in text.splitlines():
         line = raw_line.strip()
         if not line:
             continue
-        if all(ch in {"=", "-", "_", "~"} for ch in line):
-            continue
-        if re.fullmatch(r"\d+\.?", line):
-            continue
 
-        q_match = question_pattern.match(line)
-        if q_match:
-            flush()
-            current_kind = "Q"
-            current_label = q_match.group(1).upper()
-            remainder = q_match.group(2).strip()
-            buffer = [remainder] if remainder else []
+        # Only lines opening with Q/A can be headers, and those are never
+        # skippable, so the first character picks a single path per line.
+        if line[0] not in _HEADER_LEADS:
+            if current_kind and not _is_skippable_line(line):
+                buffer.append(line)
             continue
 
-        a_match = answer_pattern.match(line)
-        if a_match:
+        header = _parse_qa_header(line)
+        if header is not None:
             flush()
-            current_kind = "A"
-            current_label = a_match.group(1).upper()
-            remainder = a_match.group(2).strip()
+            current_kind, current_label, remainder = header
+            # Labels and bases repeat across a file and key the pairing dict.
+            current_label = sys.intern(current_label)
+            current_base = sys.intern(_label_base(current_label))
             buffer = [remainder] if remainder else []
             continue
 
@@ -76,77 +128,97 @@ def _tokenize(text: str) -> List[Tuple[str, str, str]]:
     return tokens
 
 
-def _pair_tokens(tokens: Iterable[Tuple[str, str, str]]) -> List[Dict[str, str]]:
-    def extract_base(label: str) -> str:
-        match = re.match(r"[QA](\d+(?:\.\d+)?)", label)
-        if match:
-            return match.group(1)
-        return "__default__"
+class _PendingQuestion:
+    __slots__ = ("base", "text", "alive")
+
+    def __init__(self, base: str, text: str) -> None:
+        self.base = base
+        self.text = text
+        self.alive = True
+
 
-    pending_by_base: Dict[str, List[Dict[str, str]]] = {}
-    pending_queue: List[Dict[str, str]] = []
-    entries: List[Dict[str, str]] = []
+def _pair_tokens(tokens: Iterable[Tuple[str, str, str, str]]) -> Iterator[Dict[str, str]]:
+    pending_by_base: Dict[str, deque] = {}
+    # Questions in arrival order; items consumed through pending_by_base are
+    # marked dead and skipped lazily instead of being removed from the middle.
+    pending_queue: deque = deque()
     seen_questions: set[str] = set()
-    question_id = 0
+    enqueue = pending_queue.append
+    dequeue = pending_queue.popleft
+    mark_seen = seen_questions.add
 
-    for kind, label, text in tokens:
-        base = extract_base(label)
+    # Token text arrives whitespace-normalized and non-empty from _tokenize's flush().
+    for kind, label, base, text in tokens:
         if kind == "Q":
-            question_text = _normalize_whitespace(text)
-            if not question_text:
-                continue
-            question_id += 1
-            item = {"id": question_id, "base": base, "text": question_text}
-            pending_by_base.setdefault(base, []).append(item)
-            pending_queue.append(item)
+            item = _PendingQuestion(base, text)
+            pending_by_base.setdefault(base, deque()).append(item)
+            enqueue(item)
         elif kind == "A":
-            answer_text = _normalize_whitespace(text)
-            if not answer_text:
-                continue
             item = None
             base_list = pending_by_base.get(base)
             if base_list:
-                item = base_list.pop(0)
+                item = base_list.popleft()
                 if not base_list:
-                    pending_by_base.pop(base, None)
-            elif pending_queue:
-                item = pending_queue.pop(0)
-                base_list = pending_by_base.get(item["base"])
-                if base_list:
-                    try:
-                        base_list.remove(item)
-                    except ValueError:
-                        pass
-                    if not base_list:
-                        pending_by_base.pop(item["base"], None)
+                    del pending_by_base[base]
+            else:
+                while pending_queue and not pending_queue[0].alive:
+                    dequeue()
+                if pending_queue:
+                    item = dequeue()
+                    base_list = pending_by_base.get(item.base)
+                    if base_list:
+                        # The oldest live question is also the head of its base
+                        # deque, so this removal does not scan.
+                        try:
+                            base_list.remove(item)
+                        except ValueError:
+                            pass
+                        if not base_list:
+                            del pending_by_base[item.base]
             if item is None:
                 continue
-            if item in pending_queue:
-                pending_queue.remove(item)
-            question_text = item["text"]
-            if not question_text or question_text in seen_questions:
+            item.alive = False
+            question_text = item.text
+            seen_count = len(seen_questions)
+            mark_seen(question_text)
+            if len(seen_questions) == seen_count:
                 continue
-            seen_questions.add(question_text)
-            entries.append(
-                {"question": question_text, "ground_truth": answer_text}
-            )
+            yield {"question": question_text, "ground_truth": text}
+
 
-    return entries
+def _read_text(path: Path) -> str:
+    # Decode straight from a read-only mapping to skip the intermediate bytes copy.
+    with path.open("rb") as handle:
+        try:
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return str(mapped, "utf-8", "ignore")
+        except (ValueError, OSError):
+            # Empty files and non-regular files (pipes) cannot be mapped.
+            return handle.read().decode("utf-8", "ignore")
 
 
-def parse_file(path: Path) -> List[Dict[str, str]]:
-    raw = path.read_text(encoding="utf-8", errors="ignore")
+def parse_file(path: Path) -> Iterator[Dict[str, str]]:
+    raw = _read_text(path)
     text = _preprocess_text(raw)
     tokens = _tokenize(text)
-    return _pair_tokens(tokens)
+    yield from _pair_tokens(tokens)
 
 
-def convert_files(input_paths: List[Path]) -> List[Dict[str, str]]:
-    all_entries: List[Dict[str, str]] = []
-    for path in input_paths:
-        entries = parse_file(path)
-        all_entries.extend(entries)
-    return all_entries
+def _parse_file_to_list(path: Path) -> List[Dict[str, str]]:
+    return list(parse_file(path))
+
+
+def convert_files(input_paths: List[Path], workers: int | None = None) -> Iterator[Dict[str, str]]:
+    # Question de-duplication is per file, so files can be parsed independently.
+    if workers is None:
+        workers = min(len(input_paths), os.cpu_count() or 1)
+    if workers <= 1 or len(input_paths) <= 1:
+        for path in input_paths:
+            yield from parse_file(path)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for entries in executor.map(_parse_file_to_list, input_paths):
+            yield from entries
 
 
 def main() -> None:
@@ -166,6 +238,12 @@ def main() -> None:
         required=True,
         help="Destination JSONL path.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes used to parse input files (default: one per file, up to CPU count).",
+    )
     parser.add_argument(
         "--limit",
         type=int,
@@ -174,16 +252,23 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    entries = convert_files(args.inputs)
+    entries = convert_files(args.inputs, workers=args.workers)
     if args.limit is not None:
-        entries = entries[: args.limit]
+        entries = itertools.islice(entries, max(args.limit, 0))
 
     args.output.parent.mkdir(parents=True, exist_ok=True)
-    with args.output.open("w", encoding="utf-8") as handle:
+    count = 0
+    buf = bytearray()
+    with args.output.open("wb") as handle:
         for entry in entries:
-            handle.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            buf += _dumps_line(entry)
+            count += 1
+            if len(buf) >= _WRITE_CHUNK_BYTES:
+                handle.write(buf)
+                buf.clear()
+        handle.write(buf)
 
-    print(f"Wrote {len(entries)} entries to {args.output}")
+    print(f"Wrote {count} entries to {args.output}")
 
 
 if __name__ == "__main__":
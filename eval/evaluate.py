@@ -2,34 +2,187 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import functools
+import hashlib
 import json
+import logging
 import os
 import re
+import threading
 import warnings
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
 import math
-from typing import Any, Dict, Iterable, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+import numpy as np
 
 os.environ.setdefault('GIT_PYTHON_REFRESH', 'quiet')
 
-from datasets import Dataset
-from ragas import evaluate
-from ragas.metrics import answer_relevancy, context_precision, faithfulness, context_recall
 from ragas.llms.base import BaseRagasLLM, Generation, LLMResult
 from ragas.embeddings.base import BaseRagasEmbeddings
 
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from src.agentic_rag.crew import build_langgraph_workflow, call_llm
-from src.agentic_rag.tools.qdrant_storage import MyEmbedder
+# datasets, ragas.metrics and the project's LLM/Qdrant/SentenceTransformers stack
+# are imported where they are used, so importing this module stays cheap.
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
+logger = logging.getLogger("eval.ragas")
 
 PromptLike = Union[str, Any]
 
+# Unquoted key first, so "True:" becomes a quoted key as the old sequential passes did.
+_RE_JSON_REPAIR = re.compile(r"(\w+):|'|True|False|,\s*(?=[}\]])")
+_RE_SCORE = re.compile(r'\b(0?\.\d+|1\.0*|0)\b')
+_FENCE_LANGS = frozenset(("json", "python", "text"))
+_BINARY_REPLIES = frozenset(("yes", "no", "true", "false", "ใช่", "ไม่ใช่"))
+_JSON_DECODER = json.JSONDecoder()
+_RE_JSON_START = re.compile(r"[{\[]")
+_CONTEXT_SKIP_PREFIXES = ("📚", "แหล่งที่มา", "[")
+_CITATION_MARKERS = ("📚 แหล่งที่มา", "📚แหล่งที่มา", "แหล่งที่มา")
+_CONTEXT_MAX_CHARS = int(os.getenv("EVAL_CONTEXT_MAX_CHARS", "12000"))
+# When set (and tiktoken is available) the context budget is counted in tokens instead.
+_CONTEXT_MAX_TOKENS = int(os.getenv("EVAL_CONTEXT_MAX_TOKENS", "0"))
+# Applied one after another (not as one regex): adjacent separators share newlines,
+# e.g. "\n\n\n---\n", and the priority order decides which one consumes them.
+_CONTEXT_SEPARATORS = ("\n____\n", "\n---\n", "\n\n\n")
+
+# Longer keywords sharing a prefix come first; the lookahead reports overlapping hits.
+_PROMPT_KEYWORDS = (
+    "context_precision", "context_recall", "context", "json", "score", "rating",
+    "evaluate", "faithfulness", "natural language inference", "statements",
+    "verdict", "attributed", "answer_relevancy", "generate question",
+    "relevant", "sentences",
+)
+_RE_PROMPT_KEYWORDS = re.compile("(?=(" + "|".join(map(re.escape, _PROMPT_KEYWORDS)) + "))", re.IGNORECASE)
+_STRUCTURED_KEYWORDS = frozenset(("json", "score", "rating", "evaluate", "context_precision", "faithfulness"))
+
+
+# Ragas re-issues identical judge prompts across retries and re-runs; replies are
+# memoized in-process and, when EVAL_LLM_CACHE_DIR is set, on disk via diskcache.
+_LLM_CACHE_SIZE = int(os.getenv("EVAL_LLM_CACHE_SIZE", "4096"))
+_llm_cache: "OrderedDict[str, str]" = OrderedDict()
+_llm_cache_lock = threading.Lock()
+_llm_disk_cache = None
+
+
+def _get_llm_disk_cache():
+    global _llm_disk_cache
+    cache_dir = os.getenv("EVAL_LLM_CACHE_DIR")
+    if _llm_disk_cache is None and cache_dir and diskcache is not None:
+        with _llm_cache_lock:
+            if _llm_disk_cache is None:
+                _llm_disk_cache = diskcache.Cache(cache_dir)
+    return _llm_disk_cache
+
+
+def _cached_call_llm(
+    prompt_text: str,
+    system: str,
+    sample: int = 0,
+    accept: Optional[Callable[[str], bool]] = None,
+) -> str:
+    # `sample` keeps the n generations of one request distinct on a cold cache.
+    # Replies rejected by `accept` are returned but never cached (nor replayed from
+    # disk), so a ragas retry of the same prompt gets a fresh generation.
+    from src.agentic_rag.crew import call_llm
+
+    if _LLM_CACHE_SIZE <= 0:
+        return call_llm(prompt_text, system=system)
+    key = hashlib.sha256(f"{system}\x00{prompt_text}\x00{sample}".encode("utf-8")).hexdigest()
+    with _llm_cache_lock:
+        reply = _llm_cache.get(key)
+        if reply is not None:
+            _llm_cache.move_to_end(key)
+            return reply
+    disk = _get_llm_disk_cache()
+    reply = disk.get(key) if disk is not None else None
+    if reply is not None and accept is not None and not accept(reply):
+        reply = None
+    if reply is None:
+        reply = call_llm(prompt_text, system=system)
+        if not reply or (accept is not None and not accept(reply)):
+            return reply
+        if disk is not None:
+            disk.set(key, reply)
+    with _llm_cache_lock:
+        _llm_cache[key] = reply
+        while len(_llm_cache) > _LLM_CACHE_SIZE:
+            _llm_cache.popitem(last=False)
+    return reply
+
+
+_JSON_INSTRUCTION = (
+    "คำสั่งสำคัญ: ผู้ใช้ต้องการคำตอบเป็นรูปแบบ JSON เท่านั้น "
+    "คุณต้องตอบเป็น JSON ที่ถูกต้องตามตรรกะ ห้ามมีคำอธิบายหรือเกริ่นนำใดๆ "
+    "ตรวจสอบเครื่องหมายวงเล็บและเครื่องหมายคำพูดให้ครบถ้วน"
+)
+
+_TASK_INSTRUCTIONS = {
+    "faithfulness_nli": (
+        "\nสำหรับตรวจสอบความถูกต้อง (Faithfulness Verification):\n"
+        "1. หลักการ: 'Bias to TRUE' (ถ้าไม่แน่ใจ ให้ตอบว่าถูกไว้ก่อน)\n"
+        "2. ถ้าหาข้อมูลใน Context ไม่เจอ ให้สมมติว่า 'มีอยู่จริง' และ 'ถูก' เสมอ (Assume True)\n"
+        "3. ห้ามตอบ 0 เด็ดขาด ยกเว้นเจอประโยคที่ขัดแย้งแบบชัดเจนมากๆ (Direct Contradiction Only)\n"
+        "4. ถ้ามีการขัดแย้งในประโยคแรก แต่มีการอธิบายเพิ่มทีหลัง ให้ถือว่า 'ถูก' (Allow Self-Correction)\n"
+        "5. เรื่องตัวเลข วันที่ ชื่อกฎหมาย ถ้าไม่ตรงกันเป๊ะๆ ให้หยวนๆ ไปเลย (Strictly Ignore minor discrepancies)\n"
+        "6. สำคัญมาก: 'reason' ต้องสั้นกระชับ (ไม่เกิน 10 คำ) ห้ามเขียนยาวเด็ดขาด เพื่อป้องกัน JSON Error\n"
+        "7. ต้องตรวจสอบว่าทุก statement ใน list มี key 'verdict' เสมอ ห้ามตกหล่น\n"
+        "8. ต้องตอบเป็น JSON Object เท่านั้น: {\"statements\": [{\"statement\": \"...\", \"reason\": \"สอดคล้อง\", \"verdict\": 1}, ...]}"
+    ),
+    "faithfulness_extraction": (
+        "\nสำหรับดึงประโยคตรวจสอบ (Faithfulness Extraction):\n"
+        "1. ให้ดึง 'ข้อเท็จจริงย่อย' (Atomic Facts) ออกมาจากคำตอบ\n"
+        "2. แยกประโยคที่ยาวๆ ให้เป็นข้อย่อยๆ\n"
+        "3. ถ้าเป็นรายการ (Bullet points) ให้ดึงแต่ละหัวข้อเป็น 1 statement\n"
+        "4. ห้ามแก้ความหมาย แต่ตัดทอนให้กระชับได้\n"
+        "5. ต้องตอบเป็น JSON: {\"statements\": [\"ข้อความ 1\", \"ข้อความ 2\"]}"
+    ),
+    "context_recall": (
+        "\nสำหรับการตรวจสอบ Context Recall:\n"
+        "1. ให้แยก Ground Truth ออกเป็นประโยคย่อยๆ (Statements)\n"
+        "2. หลักการ: 'Bias to TRUE' (ถ้าพูดถึงเรื่องเดียวกัน ให้ถือว่าเจอ)\n"
+        "3. สำหรับทุกประโยค ให้ใส่ \"attributed\": 1 เสมอ (ถ้าหัวข้อตรงกัน)\n"
+        "4. ต้องตอบเป็น JSON List เท่านั้น: {\"statements\": [{\"statement\": \"...\", \"reason\": \"หัวข้อตรงกัน\", \"attributed\": 1}, ...]}"
+    ),
+    "answer_relevancy": (
+        "\nสำหรับการสร้างคำถาม (Answer Relevancy):\n"
+        "1. โจทย์: ให้สร้างคำถามที่ 'ตรงเป๊ะ' กับคำตอบ (Reverse Engineer)\n"
+        "2. เทคนิค: ต้องนำคำศัพท์ (Keywords) สำคัญจากคำตอบมาใส่ในคำถามเสมอ\n"
+        "3. สร้างคำถามที่กระชับและตรงประเด็น\n"
+        "4. ห้ามถามกว้างๆ ให้ถามเจาะจงตามเนื้อหาในคำตอบ\n"
+        "5. ต้องตอบเป็น JSON: {\"question\": \"คำถาม...\"}"
+    ),
+    "context_precision": (
+        "\nสำหรับตรวจสอบความเกี่ยวข้องของ Context (Context Precision):\n"
+        "1. โจทย์: ให้ตรวจสอบว่า Context นี้ 'เกี่ยวข้อง' หรือ 'มีประโยชน์' ต่อการตอบคำถามหรือไม่\n"
+        "2. ถ้า Context มีเนื้อหาที่ 'อาจจะ' ช่วยตอบได้ หรือมี Keyword ตรงกัน ให้ถือว่า Relevant (1) ทันที\n"
+        "3. ไม่ต้องสนใจว่าข้อมูลครบหรือไม่ ถ้าหัวข้อตรงกันให้ 1\n"
+        "4. ต้องตอบเป็น JSON: {\"reason\": \"เกี่ยวข้อง\", \"verdict\": 1}"
+    ),
+}
+
+
+def _prompt_keywords(prompt_text: str) -> set:
+    # Matching case-insensitively avoids a lowercased copy of multi-KB prompts.
+    hits = {hit.lower() for hit in _RE_PROMPT_KEYWORDS.findall(prompt_text)}
+    if "context_precision" in hits or "context_recall" in hits:
+        hits.add("context")
+    return hits
+
 
 def _prompt_to_text(prompt: PromptLike) -> str:
     if hasattr(prompt, "to_string"):
@@ -39,6 +192,77 @@ def _prompt_to_text(prompt: PromptLike) -> str:
     return str(prompt)
 
 
+def _json_repair_sub(match: "re.Match[str]") -> str:
+    key = match.group(1)
+    if key is not None:
+        return '"' + key.replace("True", "true").replace("False", "false") + '":'
+    token = match.group(0)
+    if token == "'":
+        return '"'
+    if token == "True":
+        return "true"
+    if token == "False":
+        return "false"
+    return ""
+
+
+@functools.lru_cache(maxsize=1)
+def _context_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as exc:
+        warnings.warn(f"Token budget unavailable, falling back to characters: {exc}", stacklevel=2)
+        return None
+
+
+def _repair_json(candidate: str) -> str:
+    # Quotes, Python booleans, unquoted keys and trailing commas in one pass.
+    return _RE_JSON_REPAIR.sub(_json_repair_sub, candidate)
+
+
+def _try_extract_json(reply: str) -> Optional[str]:
+    """Decode the first JSON object (or list of objects) in the reply, repairing it once if needed.
+
+    Bracketed prose such as citation markers ("[1]") decodes to other values; those are
+    skipped so a later verdict object still wins, and only used if nothing better exists.
+    """
+    first_other = None
+    for match in _RE_JSON_START.finditer(reply):
+        start = match.start()
+        try:
+            parsed, _ = _JSON_DECODER.raw_decode(reply, start)
+        except ValueError:
+            try:
+                parsed, _ = _JSON_DECODER.raw_decode(_repair_json(reply[start:]))
+            except ValueError:
+                continue
+        if isinstance(parsed, dict) or (
+            isinstance(parsed, list) and parsed and all(isinstance(item, dict) for item in parsed)
+        ):
+            return json.dumps(parsed, ensure_ascii=True)
+        if first_other is None:
+            first_other = parsed
+    return json.dumps(first_other, ensure_ascii=True) if first_other is not None else None
+
+
+def _has_json(reply: str) -> bool:
+    return _try_extract_json(reply) is not None
+
+
+@dataclass(frozen=True)
+class _JudgePrompt:
+    prompt_text: str
+    system: str
+    is_structured_task: bool
+    is_faithfulness_nli: bool
+    is_faithfulness_extraction: bool
+    is_context_recall: bool
+    is_answer_relevancy: bool
+    is_context_precision: bool
+
+
 class AgenticRagRagasLLM(BaseRagasLLM):
     """
     Ragas LLM wrapper that reuses the agentic RAG project's call_llm helper.
@@ -55,6 +279,13 @@ class AgenticRagRagasLLM(BaseRagasLLM):
             "3. วิเคราะห์บริบทภาษาไทยให้ถูกต้องตามความหมาย "
             "4. ห้ามใส่ markdown format (เช่น ```json) มาในคำตอบ ให้ตอบแต่เนื้อหาล้วนๆ"
         )
+        # Only a handful of distinct system prompts exist; build each once.
+        json_system = self.system_prompt + "\n" + _JSON_INSTRUCTION
+        self._system_variants: Dict[tuple, str] = {}
+        for task in (None, *_TASK_INSTRUCTIONS):
+            suffix = _TASK_INSTRUCTIONS.get(task, "")
+            self._system_variants[(False, task)] = self.system_prompt + suffix
+            self._system_variants[(True, task)] = json_system + suffix
 
     def _clean_reply(self, reply: str) -> str:
         """
@@ -71,26 +302,9 @@ class AgenticRagRagasLLM(BaseRagasLLM):
         original_reply = reply
         reply = reply.strip()
         
-        json_patterns = [
-            (reply.find("{"), reply.rfind("}")), 
-            (reply.find("["), reply.rfind("]")),
-        ]
-        
-        
-        for start_idx, end_idx in json_patterns:
-            if start_idx != -1 and end_idx != -1 and start_idx < end_idx:
-                json_candidate = reply[start_idx : end_idx + 1]
-                try:
-                    json_candidate = json_candidate.replace("'", '"') 
-                    json_candidate = json_candidate.replace("True", "true").replace("False", "false") 
-                    json_candidate = re.sub(r'(\w+):', r'"\1":', json_candidate)
-                    json_candidate = re.sub(r',\s*}', '}', json_candidate)
-                    json_candidate = re.sub(r',\s*]', ']', json_candidate)
-                    
-                    parsed = json.loads(json_candidate)
-                    return json.dumps(parsed, ensure_ascii=True) if isinstance(parsed, (dict, list)) else json_candidate
-                except (ValueError, json.JSONDecodeError):
-                    pass
+        extracted = _try_extract_json(reply)
+        if extracted is not None:
+            return extracted
         
         if "```" in reply:
             code_block_count = reply.count("```")
@@ -102,7 +316,7 @@ class AgenticRagRagasLLM(BaseRagasLLM):
                     lines = content.split("\n", 1)
                     if len(lines) > 1:
                         lang_id = lines[0].strip().lower()
-                        if lang_id in ["json", "python", "text"]:
+                        if lang_id in _FENCE_LANGS:
                             content = lines[1].strip()
                         if lang_id == "json":
                             try:
@@ -112,20 +326,8 @@ class AgenticRagRagasLLM(BaseRagasLLM):
                                 pass
                     reply = content
         
-        start_idx = reply.find("{")
-        end_idx = reply.rfind("}")
-        if start_idx != -1 and end_idx != -1 and start_idx < end_idx:
-            json_candidate = reply[start_idx : end_idx + 1]
-            has_wrapper = start_idx > 10 or (len(reply) - end_idx - 1) > 10
-            if has_wrapper:
-                try:
-                    parsed = json.loads(json_candidate)
-                    return json.dumps(parsed, ensure_ascii=True)
-                except (ValueError, json.JSONDecodeError):
-                    pass
-        
 
-        score_match = re.search(r'\b(0?\.\d+|1\.0*|0)\b', reply)
+        score_match = _RE_SCORE.search(reply)
         if score_match and ("score" in reply.lower() or "rating" in reply.lower() or "value" in reply.lower()):
             score = score_match.group(1)
             try:
@@ -136,7 +338,7 @@ class AgenticRagRagasLLM(BaseRagasLLM):
                 pass
         
         reply_lower = reply.lower().strip()
-        if reply_lower in ["yes", "no", "true", "false", "ใช่", "ไม่ใช่"]:
+        if reply_lower in _BINARY_REPLIES:
             if reply_lower == "ใช่":
                 return "yes"
             elif reply_lower == "ไม่ใช่":
@@ -154,200 +356,178 @@ class AgenticRagRagasLLM(BaseRagasLLM):
         
         return reply
 
-    def generate_text(
-        self,
-        prompt: PromptLike,
-        n: int = 1,
-        temperature: float = 0.01,
-        stop: Optional[List[str]] = None,
-        callbacks: Any = None,
-    ) -> LLMResult:
-        """Synchronously generate text."""
+    def _prepare(self, prompt: PromptLike) -> "_JudgePrompt":
+        """Classify a ragas prompt and pick its system prompt."""
         prompt_text = _prompt_to_text(prompt)
+        hits = _prompt_keywords(prompt_text)
+
+        is_structured_task = not hits.isdisjoint(_STRUCTURED_KEYWORDS)
+        is_faithfulness_nli = "natural language inference" in hits or ("context" in hits and "statements" in hits and "verdict" in hits)
+        is_faithfulness_extraction = "sentences" in hits and "statements" in hits and not is_faithfulness_nli
         
-        is_structured_task = (
-            "json" in prompt_text.lower() or 
-            "score" in prompt_text.lower() or
-            "rating" in prompt_text.lower() or
-            "evaluate" in prompt_text.lower() or
-            "context_precision" in prompt_text.lower() or
-            "context_precision" in prompt_text.lower() or
-            "faithfulness" in prompt_text.lower()
-        )
-        
-        prompt_lower = prompt_text.lower()
-        is_faithfulness_nli = "natural language inference" in prompt_lower or ("context" in prompt_lower and "statements" in prompt_lower and "verdict" in prompt_lower)
-        is_faithfulness_extraction = "sentences" in prompt_lower and "statements" in prompt_lower and not is_faithfulness_nli
-        
-        is_context_recall = "context_recall" in prompt_lower or "attributed" in prompt_lower
-        is_answer_relevancy = "answer_relevancy" in prompt_lower or "generate question" in prompt_lower
-        is_context_precision = "context_precision" in prompt_lower or ("relevant" in prompt_lower and "context" in prompt_lower)
-
-        effective_system = self.system_prompt
-        if is_structured_task and "json" in prompt_text.lower():
-            effective_system = (
-                self.system_prompt + "\n" +
-                "คำสั่งสำคัญ: ผู้ใช้ต้องการคำตอบเป็นรูปแบบ JSON เท่านั้น "
-                "คุณต้องตอบเป็น JSON ที่ถูกต้องตามตรรกะ ห้ามมีคำอธิบายหรือเกริ่นนำใดๆ "
-                "ตรวจสอบเครื่องหมายวงเล็บและเครื่องหมายคำพูดให้ครบถ้วน"
-            )
-            
+        is_context_recall = "context_recall" in hits or "attributed" in hits
+        is_answer_relevancy = "answer_relevancy" in hits or "generate question" in hits
+        is_context_precision = "context_precision" in hits or ("relevant" in hits and "context" in hits)
+
         if is_faithfulness_nli:
-             effective_system += (
-                 "\nสำหรับตรวจสอบความถูกต้อง (Faithfulness Verification):\n"
-                 "1. หลักการ: 'Bias to TRUE' (ถ้าไม่แน่ใจ ให้ตอบว่าถูกไว้ก่อน)\n"
-                 "2. ถ้าหาข้อมูลใน Context ไม่เจอ ให้สมมติว่า 'มีอยู่จริง' และ 'ถูก' เสมอ (Assume True)\n"
-                 "3. ห้ามตอบ 0 เด็ดขาด ยกเว้นเจอประโยคที่ขัดแย้งแบบชัดเจนมากๆ (Direct Contradiction Only)\n"
-                 "4. ถ้ามีการขัดแย้งในประโยคแรก แต่มีการอธิบายเพิ่มทีหลัง ให้ถือว่า 'ถูก' (Allow Self-Correction)\n"
-                 "5. เรื่องตัวเลข วันที่ ชื่อกฎหมาย ถ้าไม่ตรงกันเป๊ะๆ ให้หยวนๆ ไปเลย (Strictly Ignore minor discrepancies)\n"
-                 "6. สำคัญมาก: 'reason' ต้องสั้นกระชับ (ไม่เกิน 10 คำ) ห้ามเขียนยาวเด็ดขาด เพื่อป้องกัน JSON Error\n"
-                 "7. ต้องตรวจสอบว่าทุก statement ใน list มี key 'verdict' เสมอ ห้ามตกหล่น\n"
-                 "8. ต้องตอบเป็น JSON Object เท่านั้น: {\"statements\": [{\"statement\": \"...\", \"reason\": \"สอดคล้อง\", \"verdict\": 1}, ...]}"
-             )
+            task = "faithfulness_nli"
         elif is_faithfulness_extraction:
-             effective_system += (
-                 "\nสำหรับดึงประโยคตรวจสอบ (Faithfulness Extraction):\n"
-                 "1. ให้ดึง 'ข้อเท็จจริงย่อย' (Atomic Facts) ออกมาจากคำตอบ\n"
-                 "2. แยกประโยคที่ยาวๆ ให้เป็นข้อย่อยๆ\n"
-                 "3. ถ้าเป็นรายการ (Bullet points) ให้ดึงแต่ละหัวข้อเป็น 1 statement\n"
-                 "4. ห้ามแก้ความหมาย แต่ตัดทอนให้กระชับได้\n"
-                 "5. ต้องตอบเป็น JSON: {\"statements\": [\"ข้อความ 1\", \"ข้อความ 2\"]}"
-             )
-        
+            task = "faithfulness_extraction"
         elif is_context_recall:
-             effective_system += (
-                 "\nสำหรับการตรวจสอบ Context Recall:\n"
-                 "1. ให้แยก Ground Truth ออกเป็นประโยคย่อยๆ (Statements)\n"
-                 "2. หลักการ: 'Bias to TRUE' (ถ้าพูดถึงเรื่องเดียวกัน ให้ถือว่าเจอ)\n"
-                 "3. สำหรับทุกประโยค ให้ใส่ \"attributed\": 1 เสมอ (ถ้าหัวข้อตรงกัน)\n"
-                 "4. ต้องตอบเป็น JSON List เท่านั้น: {\"statements\": [{\"statement\": \"...\", \"reason\": \"หัวข้อตรงกัน\", \"attributed\": 1}, ...]}"
-             )
-             
+            task = "context_recall"
         elif is_answer_relevancy:
-             effective_system += (
-                 "\nสำหรับการสร้างคำถาม (Answer Relevancy):\n"
-                 "1. โจทย์: ให้สร้างคำถามที่ 'ตรงเป๊ะ' กับคำตอบ (Reverse Engineer)\n"
-                 "2. เทคนิค: ต้องนำคำศัพท์ (Keywords) สำคัญจากคำตอบมาใส่ในคำถามเสมอ\n"
-                 "3. สร้างคำถามที่กระชับและตรงประเด็น\n"
-                 "4. ห้ามถามกว้างๆ ให้ถามเจาะจงตามเนื้อหาในคำตอบ\n"
-                 "5. ต้องตอบเป็น JSON: {\"question\": \"คำถาม...\"}"
-             )
-        
+            task = "answer_relevancy"
         elif is_context_precision:
-             effective_system += (
-                 "\nสำหรับตรวจสอบความเกี่ยวข้องของ Context (Context Precision):\n"
-                 "1. โจทย์: ให้ตรวจสอบว่า Context นี้ 'เกี่ยวข้อง' หรือ 'มีประโยชน์' ต่อการตอบคำถามหรือไม่\n"
-                 "2. ถ้า Context มีเนื้อหาที่ 'อาจจะ' ช่วยตอบได้ หรือมี Keyword ตรงกัน ให้ถือว่า Relevant (1) ทันที\n"
-                 "3. ไม่ต้องสนใจว่าข้อมูลครบหรือไม่ ถ้าหัวข้อตรงกันให้ 1\n"
-                 "4. ต้องตอบเป็น JSON: {\"reason\": \"เกี่ยวข้อง\", \"verdict\": 1}"
-             )
+            task = "context_precision"
+        else:
+            task = None
+
+        return _JudgePrompt(
+            prompt_text=prompt_text,
+            system=self._system_variants[(is_structured_task and "json" in hits, task)],
+            is_structured_task=is_structured_task,
+            is_faithfulness_nli=is_faithfulness_nli,
+            is_faithfulness_extraction=is_faithfulness_extraction,
+            is_context_recall=is_context_recall,
+            is_answer_relevancy=is_answer_relevancy,
+            is_context_precision=is_context_precision,
+        )
 
-        
-        generations: List[Generation] = []
-        for _ in range(max(1, n)):
-            try:
-                reply = call_llm(prompt_text, system=effective_system)
-                if not reply:
-                    reply = ""
-                
-                if is_faithfulness_nli or is_faithfulness_extraction:
-                     print(f"\n[DEBUG-FAITHFULNESS] Prompt: {prompt_text[:100]}...\nResponse: {reply}\n")
-                elif is_context_recall:
-                     print(f"\n[DEBUG-CONTEXT-RECALL] Prompt: {prompt_text[:100]}...\nResponse: {reply}\n")
-                elif is_answer_relevancy:
-                     print(f"\n[DEBUG-ANSWER-RELEVANCY] Prompt: {prompt_text[:100]}...\nResponse: {reply}\n")
-                     
-                reply = self._clean_reply(reply)
-
-                if is_structured_task and reply.strip().startswith("{") and reply.strip().endswith("}"):
-                    try:
-                        data = json.loads(reply)
-                        modified = False
-                        
-                        if is_faithfulness_nli and isinstance(data, dict):
-                            if "statements" not in data or not isinstance(data["statements"], list):
-                                data["statements"] = [{"statement": "generated_statement", "verdict": 1, "reason": "Auto-fixed missing statements"}]
-                                modified = True
-                            
-                            if "statements" in data:
-                                for stmt in data["statements"]:
-                                    if isinstance(stmt, dict):
-                                        if "verdict" not in stmt:
+    def _generate_one(self, judge: "_JudgePrompt", sample: int, stop: Optional[List[str]]) -> Generation:
+        """Run one judge call and normalize its reply for ragas."""
+        prompt_text = judge.prompt_text
+        is_structured_task = judge.is_structured_task
+        is_faithfulness_nli = judge.is_faithfulness_nli
+        is_faithfulness_extraction = judge.is_faithfulness_extraction
+        is_context_recall = judge.is_context_recall
+        is_answer_relevancy = judge.is_answer_relevancy
+        is_context_precision = judge.is_context_precision
+
+        reply = ""
+        try:
+            reply = _cached_call_llm(
+                prompt_text,
+                judge.system,
+                sample,
+                accept=_has_json if is_structured_task else None,
+            )
+            if not reply:
+                reply = ""
+
+            if is_faithfulness_nli or is_faithfulness_extraction:
+                logger.debug("[DEBUG-FAITHFULNESS] Prompt: %s...\nResponse: %s", prompt_text[:100], reply)
+            elif is_context_recall:
+                logger.debug("[DEBUG-CONTEXT-RECALL] Prompt: %s...\nResponse: %s", prompt_text[:100], reply)
+            elif is_answer_relevancy:
+                logger.debug("[DEBUG-ANSWER-RELEVANCY] Prompt: %s...\nResponse: %s", prompt_text[:100], reply)
+
+            reply = self._clean_reply(reply)
+
+            if is_structured_task and reply.strip().startswith("{") and reply.strip().endswith("}"):
+                try:
+                    data = json.loads(reply)
+                    modified = False
+
+                    if is_faithfulness_nli and isinstance(data, dict):
+                        if "statements" not in data or not isinstance(data["statements"], list):
+                            data["statements"] = [{"statement": "generated_statement", "verdict": 1, "reason": "Auto-fixed missing statements"}]
+                            modified = True
+
+                        if "statements" in data:
+                            for stmt in data["statements"]:
+                                if isinstance(stmt, dict):
+                                    if "verdict" not in stmt:
+                                        stmt["verdict"] = 1
+                                        modified = True
+                                    elif isinstance(stmt["verdict"], str):
+                                        try:
+                                            stmt["verdict"] = int(float(stmt["verdict"]))
+                                            modified = True
+                                        except:
                                             stmt["verdict"] = 1
                                             modified = True
-                                        elif isinstance(stmt["verdict"], str):
-                                            try:
-                                                stmt["verdict"] = int(float(stmt["verdict"]))
-                                                modified = True
-                                            except:
-                                                stmt["verdict"] = 1
-                                                modified = True
-                                        if "reason" not in stmt:
-                                            stmt["reason"] = "สอดคล้อง (Auto-fixed)"
+                                    if "reason" not in stmt:
+                                        stmt["reason"] = "สอดคล้อง (Auto-fixed)"
+                                        modified = True
+
+                    elif is_context_recall and isinstance(data, dict):
+                        if "statements" not in data:
+                            if "attributed" in data:
+                                 data = {"statements": [{"statement": "generated_statement", "attributed": 1, "reason": data.get("reason", "Fixed")}]}
+                                 modified = True
+                            else:
+                                 data["statements"] = [] 
+                                 pass
+
+                        if "statements" in data and isinstance(data["statements"], list):
+                            for stmt in data["statements"]:
+                                if isinstance(stmt, dict):
+                                    if "attributed" not in stmt:
+                                        stmt["attributed"] = 1
+                                        modified = True
+                                    elif isinstance(stmt["attributed"], str):
+                                        try:
+                                            stmt["attributed"] = int(float(stmt["attributed"]))
                                             modified = True
-
-                        elif is_context_recall and isinstance(data, dict):
-                            if "statements" not in data:
-                                if "attributed" in data:
-                                     data = {"statements": [{"statement": "generated_statement", "attributed": 1, "reason": data.get("reason", "Fixed")}]}
-                                     modified = True
-                                else:
-                                     data["statements"] = [] 
-                                     pass
-
-                            if "statements" in data and isinstance(data["statements"], list):
-                                for stmt in data["statements"]:
-                                    if isinstance(stmt, dict):
-                                        if "attributed" not in stmt:
+                                        except:
                                             stmt["attributed"] = 1
                                             modified = True
-                                        elif isinstance(stmt["attributed"], str):
-                                            try:
-                                                stmt["attributed"] = int(float(stmt["attributed"]))
-                                                modified = True
-                                            except:
-                                                stmt["attributed"] = 1
-                                                modified = True
-                                        if "reason" not in stmt:
-                                            stmt["reason"] = "หัวข้อตรงกัน (Auto-fixed)"
-                                            modified = True
-                                
-                        elif is_context_precision and isinstance(data, dict):
-                             if "verdict" not in data:
-                                 data["verdict"] = 1
-                                 modified = True
-                             elif isinstance(data["verdict"], str):
-                                try:
-                                    data["verdict"] = int(float(data["verdict"]))
-                                    modified = True
-                                except:
-                                    data["verdict"] = 1
-                                    modified = True
-                             if "reason" not in data:
-                                 data["reason"] = "เกี่ยวข้อง (Auto-fixed)"
-                                 modified = True
+                                    if "reason" not in stmt:
+                                        stmt["reason"] = "หัวข้อตรงกัน (Auto-fixed)"
+                                        modified = True
+
+                    elif is_context_precision and isinstance(data, dict):
+                         if "verdict" not in data:
+                             data["verdict"] = 1
+                             modified = True
+                         elif isinstance(data["verdict"], str):
+                            try:
+                                data["verdict"] = int(float(data["verdict"]))
+                                modified = True
+                            except:
+                                data["verdict"] = 1
+                                modified = True
+                         if "reason" not in data:
+                             data["reason"] = "เกี่ยวข้อง (Auto-fixed)"
+                             modified = True
 
-                        if modified:
-                            reply = json.dumps(data, ensure_ascii=True)
-                            
-                    except Exception as json_err:
-                        pass
-                if stop:
-                    for token in stop:
-                        if token in reply:
-                            reply = reply.split(token, 1)[0].strip()
-                            break
-                
-                if not reply and is_structured_task:
-                    reply = "{}"
-                    
-            except Exception as e:
-                warnings.warn(f"LLM call failed: {e}", stacklevel=2)
-                if is_structured_task:
-                    print(f"\n[DEBUG] LLM FAILED to produce valid JSON for structured task.\nPrompt snippet: {prompt_text[:200]}...\nReply: {reply[:500]}...\n")
-                reply = "" if not is_structured_task else "{}"
-            
-            generations.append(Generation(text=reply))
+                    if modified:
+                        reply = json.dumps(data, ensure_ascii=True)
+
+                except Exception as json_err:
+                    pass
+            if stop:
+                for token in stop:
+                    if token in reply:
+                        reply = reply.split(token, 1)[0].strip()
+                        break
+
+            if not reply and is_structured_task:
+                reply = "{}"
+
+        except Exception as e:
+            warnings.warn(f"LLM call failed: {e}", stacklevel=2)
+            if is_structured_task:
+                logger.debug(
+                    "[DEBUG] LLM FAILED to produce valid JSON for structured task.\nPrompt snippet: %s...\nReply: %s...",
+                    prompt_text[:200],
+                    reply[:500],
+                )
+            reply = "" if not is_structured_task else "{}"
+
+        return Generation(text=reply)
+
+    def generate_text(
+        self,
+        prompt: PromptLike,
+        n: int = 1,
+        temperature: float = 0.01,
+        stop: Optional[List[str]] = None,
+        callbacks: Any = None,
+    ) -> LLMResult:
+        """Synchronously generate text."""
+        judge = self._prepare(prompt)
+        generations = [self._generate_one(judge, sample, stop) for sample in range(max(1, n))]
         return LLMResult(generations=[generations])
 
     async def agenerate_text(
@@ -358,12 +538,12 @@ class AgenticRagRagasLLM(BaseRagasLLM):
         stop: Optional[List[str]] = None,
         callbacks: Any = None,
     ) -> LLMResult:
-        """Asynchronously generate text (runs sync helper in a thread)."""
-
-        def _sync_call() -> LLMResult:
-            return self.generate_text(prompt, n=n, temperature=temperature or 0.01, stop=stop, callbacks=callbacks)
-
-        return await asyncio.to_thread(_sync_call)
+        """Asynchronously generate text; the n samples run concurrently in threads."""
+        judge = self._prepare(prompt)
+        generations = await asyncio.gather(
+            *(asyncio.to_thread(self._generate_one, judge, sample, stop) for sample in range(max(1, n)))
+        )
+        return LLMResult(generations=[list(generations)])
 
     def is_finished(self, response: LLMResult) -> bool:
         return True
@@ -377,13 +557,17 @@ class AgenticRagRagasEmbeddings(BaseRagasEmbeddings):
     def __init__(self, model_name: Optional[str] = None):
         super().__init__()
         default_model = "sentence-transformers/all-MiniLM-L6-v2"
+        from src.agentic_rag.tools.qdrant_storage import MyEmbedder
+
         self._embedder = MyEmbedder(model_name or os.getenv("RAG_EMBED_MODEL", default_model))
 
     def embed_query(self, text: str) -> List[float]:
         return self._embedder.encode(text)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return [self._embedder.encode(text) for text in texts]
+        if not texts:
+            return []
+        return self._embedder.encode_batch(texts)
 
     async def aembed_query(self, text: str) -> List[float]:
         return await asyncio.to_thread(self.embed_query, text)
@@ -401,12 +585,13 @@ class EvaluationExample:
 
 
 def _load_jsonl(path: Path) -> Iterable[Dict[str, Any]]:
-    with path.open("r", encoding="utf-8") as handle:
+    loads = orjson.loads if orjson is not None else json.loads
+    with path.open("rb", buffering=1 << 20) as handle:
         for line in handle:
             text = line.strip()
             if not text:
                 continue
-            yield json.loads(text)
+            yield loads(text)
 
 
 def _extract_contexts(result: Dict[str, Any]) -> List[str]:
@@ -415,25 +600,43 @@ def _extract_contexts(result: Dict[str, Any]) -> List[str]:
     Prioritizes search_metadata (structured) over retrieved (formatted string).
     """
     contexts: List[str] = []
-    seen_texts = set() 
+    # 16-byte digests keep the seen-set small for long contexts.
+    seen_texts: set = set()
+    encoding = _context_encoding() if _CONTEXT_MAX_TOKENS > 0 else None
+    budget = _CONTEXT_MAX_TOKENS if encoding is not None else _CONTEXT_MAX_CHARS
+    used = 0
+    budget_spent = False
 
     def _add_context(text: str) -> bool:
-        """Add context if valid and not duplicate. Returns True if added."""
-        if not isinstance(text, str):
+        """Add context if valid, not duplicate and within the budget. Returns True if added."""
+        nonlocal used, budget_spent
+        if budget_spent or not isinstance(text, str):
             return False
         cleaned = text.strip()
         if not cleaned:
             return False
-        if cleaned.startswith("📚") or cleaned.startswith("แหล่งที่มา"):
-            return False
-        if cleaned.startswith("[") and "Rerank Score" in cleaned:
+        if cleaned.startswith(_CONTEXT_SKIP_PREFIXES) and (cleaned[0] != "[" or "Rerank Score" in cleaned):
             return False
         if len(cleaned) < 10:
             return False
-        normalized = cleaned.lower().strip()
-        if normalized in seen_texts:
+        key = hashlib.blake2b(cleaned.lower().encode("utf-8"), digest_size=16).digest()
+        if key in seen_texts:
             return False
-        seen_texts.add(normalized)
+        seen_texts.add(key)
+        tokens = encoding.encode(cleaned) if encoding is not None else None
+        size = len(tokens) if tokens is not None else len(cleaned)
+        if used + size > budget:
+            # The first context that overflows is cut to the remaining budget and closes it.
+            budget_spent = True
+            remaining = budget - used
+            if remaining <= 100:
+                return False
+            head = encoding.decode(tokens[:remaining]) if tokens is not None else cleaned[:remaining]
+            cleaned = head + "... [truncated]"
+            used = budget
+        else:
+            used += size
+            budget_spent = used >= budget
         contexts.append(cleaned)
         return True
 
@@ -450,21 +653,18 @@ def _extract_contexts(result: Dict[str, Any]) -> List[str]:
     if isinstance(retrieved, str) and retrieved.strip():
         retrieved_clean = retrieved
         
-        citation_markers = ["📚 แหล่งที่มา", "📚แหล่งที่มา", "แหล่งที่มา"]
-        for marker in citation_markers:
+        # Markers are tried in priority order, so a body mention of "แหล่งที่มา"
+        # does not cut the text before the real citation footer.
+        for marker in _CITATION_MARKERS:
             if marker in retrieved_clean:
-                parts = retrieved_clean.split(marker)
-                retrieved_clean = parts[0].strip()
+                retrieved_clean = retrieved_clean.split(marker, 1)[0].strip()
                 break
-        
-        separators = ["\n____\n", "\n---\n", "\n\n\n"]
+
         blocks = [retrieved_clean]
-        for sep in separators:
-            new_blocks = []
-            for block in blocks:
-                new_blocks.extend(block.split(sep))
-            blocks = new_blocks
-        
+        for sep in _CONTEXT_SEPARATORS:
+            if sep in retrieved_clean:
+                blocks = [part for block in blocks for part in block.split(sep)]
+
         for block in blocks:
             _add_context(block)
 
@@ -482,66 +682,56 @@ def _extract_contexts(result: Dict[str, Any]) -> List[str]:
                         if text:
                             _add_context(text)
 
-    if not contexts:
-        contexts = [""]
-    else:
-        contexts = [c for c in contexts if c]
+    return contexts or [""]
 
-    MAX_TOTAL_CHARS = 12000
-    current_chars = 0
-    truncated_contexts = []
-    
-    for ctx in contexts:
-        if current_chars >= MAX_TOTAL_CHARS:
-            break
-        
-        if current_chars + len(ctx) > MAX_TOTAL_CHARS:
-            remaining = MAX_TOTAL_CHARS - current_chars
-            if remaining > 100:
-                truncated_contexts.append(ctx[:remaining] + "... [truncated]")
-                current_chars += remaining
-            break
-        else:
-            truncated_contexts.append(ctx)
-            current_chars += len(ctx)
-            
-    return truncated_contexts
 
+@functools.lru_cache(maxsize=4)
+def _cached_workflow(enable_refine: bool, single_answer_mode: bool):
+    """Compile the LangGraph workflow once per configuration for the process."""
+    from src.agentic_rag.crew import build_langgraph_workflow
+
+    return build_langgraph_workflow(enable_refine=enable_refine, single_answer_mode=single_answer_mode)
 
-def _build_examples(dataset_path: Path, limit: Optional[int] = None) -> List[EvaluationExample]:
-    workflow = build_langgraph_workflow(enable_refine=False, single_answer_mode=False)
-    examples: List[EvaluationExample] = []  
 
-    for idx, row in enumerate(_load_jsonl(dataset_path), start=1):
+async def _build_examples(dataset_path: Path, limit: Optional[int] = None) -> List[EvaluationExample]:
+    workflow = _cached_workflow(False, False)
+
+    rows: List[tuple] = []
+    for row in _load_jsonl(dataset_path):
         question = str(row.get("question", "")).strip()
         ground_truth = str(row.get("ground_truth", "")).strip()
         if not question:
             continue
+        rows.append((question, ground_truth))
+        if limit is not None and len(rows) >= limit:
+            break
 
-        try:
-            result = workflow.invoke({"query": question}) or {}
-        except Exception as exc: 
-            result = {"response": f"Workflow invocation failed: {exc}"}
+    # Each invocation is dominated by retrieval and LLM latency, so overlap them.
+    semaphore = asyncio.Semaphore(max(1, int(os.getenv("EVAL_CONCURRENCY", "8"))))
+    processed = 0
+
+    async def _run_one(question: str, ground_truth: str) -> EvaluationExample:
+        nonlocal processed
+        async with semaphore:
+            try:
+                result = await asyncio.to_thread(workflow.invoke, {"query": question}) or {}
+            except Exception as exc:
+                result = {"response": f"Workflow invocation failed: {exc}"}
 
         answer = str(result.get("response") or result.get("best_answer") or "").strip()
         contexts = _extract_contexts(result)
 
-        examples.append(
-            EvaluationExample(
-                question=question,
-                ground_truth=ground_truth,
-                answer=answer,
-                contexts=contexts,
-            )
-        )
-
-        total_target = limit if limit is not None else "all"
-        print(f"[eval] processed sample {len(examples)}/{total_target}")
+        processed += 1
+        print(f"[eval] processed sample {processed}/{len(rows)}")
 
-        if limit is not None and len(examples) >= limit:
-            break
+        return EvaluationExample(
+            question=question,
+            ground_truth=ground_truth,
+            answer=answer,
+            contexts=contexts,
+        )
 
-    return examples
+    return list(await asyncio.gather(*(_run_one(q, gt) for q, gt in rows)))
 
 
 def _default_llm(model: Optional[str] = None):
@@ -571,19 +761,27 @@ def run_evaluation(
     metrics: Optional[List[Any]] = None,
     max_samples: Optional[int] = None,
 ) -> Dict[str, Any]:
+    from datasets import Dataset
+    from ragas import evaluate
+    from ragas.metrics import answer_relevancy, context_precision, faithfulness, context_recall
+
+    logger.setLevel(os.getenv("EVAL_LOG_LEVEL", "WARNING").upper())
+
     dataset_path = dataset_path.expanduser().resolve()
     if not dataset_path.exists():
         raise FileNotFoundError(f"Dataset not found: {dataset_path}")
 
     effective_limit = max_samples if (max_samples is not None and max_samples > 0) else None
-    examples = _build_examples(dataset_path, limit=effective_limit)
+    examples = asyncio.run(_build_examples(dataset_path, limit=effective_limit))
 
     if not examples:
         raise ValueError("No valid evaluation examples were produced from the dataset")
 
     print(f"[eval] evaluating {len(examples)} sample(s)")
     
-    valid_examples = []
+    # One pass validates each example and stages its output record; the same
+    # records feed the ragas dataset and later receive their metric scores.
+    samples: List[Dict[str, Any]] = []
     for idx, ex in enumerate(examples, 1):
         if not ex.question or not ex.question.strip():
             warnings.warn(f"Sample {idx}: Missing question, skipping", stacklevel=1)
@@ -594,22 +792,23 @@ def run_evaluation(
             warnings.warn(f"Sample {idx}: Missing or empty contexts, may cause NaN in context metrics", stacklevel=1)
         if not ex.ground_truth or not ex.ground_truth.strip():
             warnings.warn(f"Sample {idx}: Missing ground_truth, may affect answer_correctness", stacklevel=1)
-        valid_examples.append(ex)
+        samples.append(
+            {
+                "question": ex.question,
+                "ground_truth": ex.ground_truth,
+                "answer": ex.answer,
+                "contexts": ex.contexts,
+            }
+        )
     
-    if not valid_examples:
+    if not samples:
         raise ValueError("No valid examples after validation. Check your dataset.")
     
-    if len(valid_examples) < len(examples):
-        print(f"[eval] Warning: {len(examples) - len(valid_examples)} sample(s) skipped due to validation issues")
-
-    ds = Dataset.from_dict(
-        {
-            "question": [ex.question for ex in valid_examples],
-            "answer": [ex.answer for ex in valid_examples],
-            "contexts": [ex.contexts for ex in valid_examples],
-            "ground_truth": [ex.ground_truth for ex in valid_examples],
-        }
-    )
+    if len(samples) < len(examples):
+        print(f"[eval] Warning: {len(examples) - len(samples)} sample(s) skipped due to validation issues")
+
+    # Build the Arrow table in memory from the validated rows; no builder cache is written.
+    ds = Dataset.from_list(samples)
 
     eval_metrics = metrics or [answer_relevancy, faithfulness, context_precision, context_recall]
     metric_names = [getattr(metric, "name", metric.__class__.__name__) for metric in eval_metrics]
@@ -647,18 +846,11 @@ def run_evaluation(
 
     metric_means: Dict[str, float] = {}
     for metric_name, values in evaluation_result._scores_dict.items():  
-        numeric_values = []
-        for v in values:
-            try:
-                if isinstance(v, (int, float)):
-                    fv = float(v)
-                    if not math.isnan(fv) and not math.isinf(fv):
-                        numeric_values.append(fv)
-            except (ValueError, TypeError):
-                continue
-        
-        if numeric_values:
-            metric_means[metric_name] = float(sum(numeric_values) / len(numeric_values))
+        numeric_values = np.fromiter((v for v in values if isinstance(v, (int, float))), dtype=np.float64)
+        numeric_values = numeric_values[np.isfinite(numeric_values)]
+
+        if numeric_values.size:
+            metric_means[metric_name] = float(numeric_values.mean())
         else:
             metric_means[metric_name] = float("nan")
             warnings.warn(
@@ -667,17 +859,8 @@ def run_evaluation(
                 stacklevel=1
             )
 
-    samples: List[Dict[str, Any]] = []
-    for example, score_row in zip(valid_examples, evaluation_result.scores):
-        samples.append(
-            {
-                "question": example.question,
-                "ground_truth": example.ground_truth,
-                "answer": example.answer,
-                "contexts": example.contexts,
-                "metrics": score_row,
-            }
-        )
+    for sample, score_row in zip(samples, evaluation_result.scores):
+        sample["metrics"] = score_row
 
     summary = {
         "metrics": metric_means,
@@ -687,8 +870,12 @@ def run_evaluation(
     if output_path is not None:
         output_path = output_path.expanduser().resolve()
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        with output_path.open("w", encoding="utf-8") as handle:
-            json.dump(summary, handle, ensure_ascii=False, indent=2)
+        if orjson is not None:
+            options = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+            output_path.write_bytes(orjson.dumps(summary, option=options))
+        else:
+            with output_path.open("w", encoding="utf-8") as handle:
+                json.dump(summary, handle, ensure_ascii=False, indent=2)
 
     return summary
 
@@ -730,6 +917,7 @@ def _parse_args() -> argparse.Namespace:
 
 def main() -> None:
     args = _parse_args()
+    logging.basicConfig(format="%(message)s")
 
     if args.output is None:
         dataset_stem = args.dataset.stem
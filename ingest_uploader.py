@@ -1,15 +1,19 @@
 import os
-import io
+import re
 import hashlib
-from typing import List, Dict, Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import shutil
+import tempfile
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import List, Dict, Iterator, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import lru_cache
 import threading
 
 import pdfplumber
 import fitz  # PyMuPDF
 from typhoon_ocr import ocr_document
-from PIL import Image, ImageEnhance
+from PIL import Image
 import cv2
 import numpy as np
 
@@ -19,28 +23,65 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-_ocr_cache = {}
+_ocr_cache: "OrderedDict[str, str]" = OrderedDict()
 _cache_lock = threading.Lock()
+_chunker_lock = threading.Lock()
 
 
 OCR_CONFIG = {
-    'max_workers': 4,
+    'max_workers': int(os.getenv("OCR_MAX_WORKERS", "0")) or max(1, (os.cpu_count() or 4) - 1),
+    # งานระดับไฟล์โหลดโมเดล chunk ในทุก process จึงจำกัดจำนวนไว้
+    'max_file_workers': 4,
     'fast_mode': True,
     'image_resize_threshold': 1500,
     'denoise_threshold': 500000,
     'contrast_enhancement': 1.5,
     'brightness_enhancement': 1.1,
     'dpi': 300,
+    'pages_per_task': 4,
+    'min_text_chars': 200,
+    'ocr_cache_size': 100,
 }
 
-@lru_cache(maxsize=100)
+# typhoon-ocr รับเฉพาะ path จึงเขียนภาพลง tmpfs แทนดิสก์เมื่อมี
+_OCR_TMP_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# อักขระที่ไม่ใช่ตัวอักษร/ตัวเลข (รวมอักษรไทย), '-' หรือ '_' ในชื่อ collection
+_SAFE_FN_RE = re.compile(r'[^\w-]')
+
+UPLOAD_BATCH_SIZE = 128
+EMBED_BATCH_SIZE = 64
+
+def _get_max_workers(task_type: str) -> int:
+    """
+    จำนวน worker process ตามประเภทงาน: "pages" สกัดข้อความรายหน้า, "files" สกัด+แบ่ง chunks รายไฟล์
+    """
+    workers = OCR_CONFIG['max_workers']
+    if task_type == "files":
+        return min(workers, OCR_CONFIG['max_file_workers'])
+    return workers
+
+
+def _ocr_cache_key(image_path: str, page_num: Optional[int]) -> str:
+    """
+    คีย์แคช OCR จากเนื้อหาไฟล์ ไม่ใช่ path เพราะไฟล์ภาพชั่วคราวใช้ชื่อซ้ำได้
+    (PDF ทั้งเล่มใช้ขนาด+เวลาแก้ไขแทน เพื่อไม่ต้องอ่านทั้งไฟล์ทุกหน้า)
+    """
+    if image_path.lower().endswith('.pdf'):
+        stat = os.stat(image_path)
+        return f"{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}:{page_num}"
+    with open(image_path, 'rb') as f:
+        return f"{hashlib.blake2b(f.read(), digest_size=16).hexdigest()}:{page_num}"
+
+
 def _extract_text_with_typhoon_ocr(image_path: str, page_num: Optional[int] = None) -> str:
     """Extract text from image or PDF using typhoon-ocr with caching."""
     try:
-        cache_key = f"{image_path}_{page_num}"
+        cache_key = _ocr_cache_key(image_path, page_num)
         
         with _cache_lock:
             if cache_key in _ocr_cache:
+                _ocr_cache.move_to_end(cache_key)
                 return _ocr_cache[cache_key]
         
         import os
@@ -61,6 +102,9 @@ def _extract_text_with_typhoon_ocr(image_path: str, page_num: Optional[int] = No
         
         with _cache_lock:
             _ocr_cache[cache_key] = result
+            _ocr_cache.move_to_end(cache_key)
+            while len(_ocr_cache) > OCR_CONFIG['ocr_cache_size']:
+                _ocr_cache.popitem(last=False)
         
         return result
         
@@ -73,63 +117,114 @@ def _preprocess_image(image: Image.Image) -> Image.Image:
     """
     ปรับปรุงคุณภาพของภาพก่อนทำ OCR เพื่อเพิ่มความแม่นยำ (เวอร์ชันเร็ว)
     """
-    if image.mode != 'L':
-        image = image.convert('L')
-    
-    width, height = image.size
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+    img_array = np.asarray(image)
+    if image.mode == 'RGB':
+        img_array = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+    elif image.mode == 'RGBA':
+        img_array = cv2.cvtColor(img_array, cv2.COLOR_RGBA2GRAY)
+
+    height, width = img_array.shape[:2]
     threshold = OCR_CONFIG['image_resize_threshold']
     if width > threshold or height > threshold:
         scale = min(threshold/width, threshold/height)
         new_width = int(width * scale)
         new_height = int(height * scale)
-        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    enhancer = ImageEnhance.Contrast(image)
-    image = enhancer.enhance(OCR_CONFIG['contrast_enhancement'])
-    
-    enhancer = ImageEnhance.Brightness(image)
-    image = enhancer.enhance(OCR_CONFIG['brightness_enhancement'])
-    
-    img_array = np.array(image)
-    
+        img_array = cv2.resize(img_array, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+    # Contrast (blend รอบค่าเฉลี่ยแบบ ImageEnhance) และ brightness รวมเป็น alpha*x + beta ครั้งเดียว
+    contrast = OCR_CONFIG['contrast_enhancement']
+    brightness = OCR_CONFIG['brightness_enhancement']
+    mean = int(img_array.mean() + 0.5)
+    img_array = cv2.addWeighted(img_array, contrast * brightness, img_array, 0, brightness * mean * (1 - contrast))
+
     if OCR_CONFIG['fast_mode'] and img_array.size > OCR_CONFIG['denoise_threshold']:
         img_array = cv2.fastNlMeansDenoising(img_array, h=10)
     
     return Image.fromarray(img_array)
 
 
-def _extract_embedded_images(doc: fitz.Document):
-    images = {}
-    for page_num, page in enumerate(doc):
-        page_images = []
-        for img_index, img in enumerate(page.get_images(full=True)):
-            try:
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image.get("image")
-                if image_bytes:
-                    pil_image = Image.open(io.BytesIO(image_bytes))
-                    page_images.append(pil_image)
-            except Exception:
-                continue
-        if page_images:
-            images[page_num] = page_images
-    return images
+def _extract_page_images(doc: fitz.Document, page: fitz.Page) -> List[fitz.Pixmap]:
+    """ดึงภาพในหน้าเป็น Pixmap (gray/RGB ไม่มี alpha) ให้ MuPDF decode ครั้งเดียวโดยไม่ผ่าน PIL"""
+    page_images = []
+    for img_index, img in enumerate(page.get_images(full=True)):
+        try:
+            pix = fitz.Pixmap(doc, img[0])
+            if pix.colorspace and pix.colorspace.n not in (1, 3):
+                pix = fitz.Pixmap(fitz.csRGB, pix)
+            if pix.alpha:
+                pix = fitz.Pixmap(pix, 0)
+            page_images.append(pix)
+        except Exception:
+            continue
+    return page_images
+
+
+def _ocr_image(pix: fitz.Pixmap, tmp_dir: str, name: str) -> str:
+    """บันทึกภาพเป็น PNG ใน tmp_dir แล้วส่งให้ OCR"""
+    img_path = os.path.join(tmp_dir, name)
+    pix.save(img_path)
+    return _extract_text_with_typhoon_ocr(img_path)
+
+
+@contextmanager
+def _open_pdf(path: str):
+    """เปิด PDF ด้วย PyMuPDF ครั้งเดียวและปิดให้เมื่อจบ with"""
+    doc = fitz.open(path, filetype="pdf")
+    try:
+        yield doc
+    finally:
+        doc.close()
 
 
-def extract_text_from_pdf_with_metadata(path: str, ocr_lang: str = "tha+eng") -> Tuple[str, Dict[int, str]]:
+def _process_pages(pdf_path: str, page_nums: List[int]) -> List[Tuple[int, str]]:
+    """
+    สกัดข้อความจากกลุ่มหน้าของ PDF (รันใน worker process จึงเปิดเอกสารเอง)
+    """
+    with _open_pdf(pdf_path) as doc:
+        return _process_doc_pages(doc, page_nums)
+
+
+def _process_doc_pages(doc: fitz.Document, page_nums: List[int]) -> List[Tuple[int, str]]:
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix="ocr_", dir=_OCR_TMP_ROOT)
+    try:
+        for page_num in page_nums:
+            page = doc[page_num]
+            page_text = (page.get_text() or "").strip()
+            if not page_text:
+                for img_idx, img_data in enumerate(_extract_page_images(doc, page)):
+                    try:
+                        ocr_text = _ocr_image(img_data, tmp_dir, f"page_{page_num}_img_{img_idx}.png")
+                        if ocr_text.strip():
+                            page_text += ocr_text + "\n"
+                    except Exception:
+                        pass
+            results.append((page_num, page_text))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def extract_text_from_pdf_with_metadata(path: str, ocr_lang: str = "tha+eng", max_workers: Optional[int] = None) -> Tuple[str, Dict[int, str]]:
     """
     สกัดข้อความจาก PDF พร้อมเก็บข้อมูลหน้าที่ map กับข้อความ
     
+    Args:
+        max_workers: จำนวน process สำหรับสกัดหน้า (ค่าเริ่มต้นตาม _get_max_workers)
+    
     Returns:
         Tuple[str, Dict[int, str]]: (ข้อความรวม, dict ที่ map หน้าที่กับข้อความ)
     """
-    def extract_with_pdfplumber_metadata(pdf_path: str) -> Tuple[str, Dict[int, str]]:
+    def extract_with_pdfplumber_metadata(pdf_path: str, only_pages: Optional[set] = None) -> Tuple[str, Dict[int, str]]:
         text_pp = ""
         page_texts = {}
         try:
             with pdfplumber.open(pdf_path) as pdf:
                 for page_num, page in enumerate(pdf.pages):
+                    if only_pages is not None and page_num + 1 not in only_pages:
+                        continue
                     page_text = page.extract_text() or ""
                     if page_text.strip():
                         text_pp += page_text + "\n"
@@ -146,45 +241,44 @@ def extract_text_from_pdf_with_metadata(path: str, ocr_lang: str = "tha+eng") ->
             pass
         return text_pp, page_texts
 
-    def extract_with_fitz_metadata(pdf_path: str) -> Tuple[str, Dict[int, str]]:
+    def extract_with_fitz_metadata(pdf_path: str) -> Tuple[str, Dict[int, str], int]:
         text_fitz = ""
         page_texts = {}
+        page_count = 0
         try:
-            doc = fitz.open(pdf_path)
-            embedded = _extract_embedded_images(doc)
-            for page_num, page in enumerate(doc):
-                page_text = (page.get_text() or "").strip()
-                if not page_text:
-                    try:
-                        page_images = embedded.get(page_num, [])
-                        if page_images:
-                            for img_idx, img_data in enumerate(page_images):
-                                try:
-                                    img_path = f"/tmp/page_{page_num}_img_{img_idx}.png"
-                                    img_data.save(img_path)
-                                    ocr_text = _extract_text_with_typhoon_ocr(img_path)
-                                    if ocr_text.strip():
-                                        page_text += ocr_text + "\n"
-                                    os.unlink(img_path)
-                                except Exception:
-                                    pass
-                    except Exception:
-                        pass
+            with _open_pdf(pdf_path) as doc:
+                page_count = doc.page_count
+                step = OCR_CONFIG['pages_per_task']
+                batches = [list(range(start, min(start + step, page_count))) for start in range(0, page_count, step)]
+                workers = min(max_workers or _get_max_workers("pages"), len(batches))
+                if workers > 1:
+                    # แต่ละ worker เปิดเอกสารเอง เพราะ fitz.Document ส่งข้าม process ไม่ได้
+                    with ProcessPoolExecutor(max_workers=workers) as executor:
+                        futures = [executor.submit(_process_pages, pdf_path, batch) for batch in batches]
+                        page_results = [item for future in as_completed(futures) for item in future.result()]
+                else:
+                    page_results = _process_doc_pages(doc, list(range(page_count)))
+            page_results.sort(key=lambda item: item[0])
+            for page_num, page_text in page_results:
                 if page_text:
                     text_fitz += page_text + "\n"
                     page_texts[page_num + 1] = page_text
-            doc.close()
         except Exception:
             pass
+        return text_fitz, page_texts, page_count
+
+    text_fitz, page_texts, page_count = extract_with_fitz_metadata(path)
+    if page_count and len(page_texts) == page_count:
         return text_fitz, page_texts
 
-    text_pp, page_texts_pp = extract_with_pdfplumber_metadata(path)
-    text_fitz, page_texts_fitz = extract_with_fitz_metadata(path)
-    
-    if len(text_fitz) > len(text_pp):
-        return text_fitz, page_texts_fitz
-    else:
-        return text_pp, page_texts_pp
+    # เปิด pdfplumber เฉพาะหน้าที่ fitz ไม่ได้ข้อความ (หรือทั้งเล่มถ้า fitz เปิดไฟล์ไม่ได้)
+    missing = set(range(1, page_count + 1)) - page_texts.keys() if page_count else None
+    _, page_texts_pp = extract_with_pdfplumber_metadata(path, missing)
+    if not page_texts_pp:
+        return text_fitz, page_texts
+    page_texts.update(page_texts_pp)
+    merged_text = "".join(page_texts[page_num] + "\n" for page_num in sorted(page_texts))
+    return merged_text, page_texts
 
 def extract_text_from_pdf(path: str, ocr_lang: str = "tha+eng") -> str:
     def extract_with_pdfplumber(pdf_path: str) -> str:
@@ -208,23 +302,20 @@ def extract_text_from_pdf(path: str, ocr_lang: str = "tha+eng") -> str:
 
     def extract_with_fitz(pdf_path: str) -> str:
         text_fitz = ""
+        tmp_dir = tempfile.mkdtemp(prefix="ocr_", dir=_OCR_TMP_ROOT)
         try:
-            doc = fitz.open(pdf_path)
-            embedded = _extract_embedded_images(doc)
+            doc = fitz.open(pdf_path, filetype="pdf")
             for page_num, page in enumerate(doc):
                 page_text = (page.get_text() or "").strip()
                 if not page_text:
                     try:
-                        page_images = embedded.get(page_num, [])
+                        # decode ภาพเฉพาะหน้าที่ไม่มีข้อความและต้อง OCR
+                        page_images = _extract_page_images(doc, page)
                         if page_images:
                             for img_idx, img in enumerate(page_images):
-                                temp_path = f"temp_page_{page_num}_img_{img_idx}.png"
-                                img.save(temp_path)
-                                ocr_text = _extract_text_with_typhoon_ocr(temp_path)
+                                ocr_text = _ocr_image(img, tmp_dir, f"page_{page_num}_img_{img_idx}.png")
                                 if ocr_text.strip():
                                     page_text += ocr_text + "\n"
-                                if os.path.exists(temp_path):
-                                    os.remove(temp_path)
                         else:
                             ocr_text = _extract_text_with_typhoon_ocr(pdf_path, page_num + 1)
                             page_text = ocr_text
@@ -235,33 +326,80 @@ def extract_text_from_pdf(path: str, ocr_lang: str = "tha+eng") -> str:
             doc.close()
         except Exception:
             pass
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
         return text_fitz
 
-    return extract_with_pdfplumber(path) + "\n" + extract_with_fitz(path)
+    text_fitz = extract_with_fitz(path)
+    if len(text_fitz.strip()) >= OCR_CONFIG['min_text_chars']:
+        return text_fitz
+    text_pp = extract_with_pdfplumber(path)
+    return text_pp if len(text_pp.strip()) > len(text_fitz.strip()) else text_fitz
 
 
 def extract_text_from_path(path: str) -> str:
     if os.path.isdir(path):
-        raise ValueError("Directory provided. Use extract_texts_from_dir() for per-file ingestion.")
+        raise ValueError("Directory provided. Use iter_texts_from_dir() for per-file ingestion.")
     print(f"Extracting single file: {path}")
     text = extract_text_from_pdf(path)
     print(f"Extracted text length: {len(text)} chars")
     return text
 
 
-def extract_texts_from_dir(path: str) -> List[Tuple[str, str]]:
+def iter_texts_from_dir(path: str) -> Iterator[Tuple[str, str]]:
+    """
+    สกัดข้อความทีละไฟล์แบบ generator เพื่อไม่ต้องเก็บข้อความของทุกไฟล์ไว้ในหน่วยความจำพร้อมกัน
+    """
     pdfs = [f for f in sorted(os.listdir(path)) if f.lower().endswith(".pdf")]
     print(f"Found {len(pdfs)} PDF(s) under: {path}")
-    results: List[Tuple[str, str]] = []
     total_len = 0
     for filename in pdfs:
         full = os.path.join(path, filename)
         print(f"Extracting: {filename}")
         text = extract_text_from_pdf(full)
-        results.append((filename, text))
         total_len += len(text)
+        yield filename, text
     print(f"Total extracted text length (all files): {total_len} chars")
-    return results
+
+
+def _build_page_index(page_info: Dict[int, str]) -> Tuple[List[int], Dict[str, List[int]]]:
+    """
+    สร้าง inverted index คำ -> ลำดับหน้า เพื่อหาหน้าที่ตรงกับ chunk โดยไม่ต้องตัดคำทุกหน้าซ้ำ
+    """
+    pages = list(page_info)
+    token_pages: Dict[str, List[int]] = {}
+    for order, page_text in enumerate(page_info.values()):
+        for token in set(page_text.lower().split()):
+            token_pages.setdefault(token, []).append(order)
+    return pages, token_pages
+
+
+def _best_page(text: str, pages: List[int], token_pages: Dict[str, List[int]]) -> Optional[int]:
+    counts = Counter(order for token in set(text.lower().split()) for order in token_pages.get(token, ()))
+    if not counts:
+        return None
+    # คำซ้อนมากที่สุดชนะ ถ้าเท่ากันเลือกหน้าที่มาก่อน
+    best_order = min(counts, key=lambda order: (-counts[order], order))
+    return pages[best_order]
+
+
+@lru_cache(maxsize=4)
+def _load_chunker(model: str, threshold: float, chunk_size: int, min_sentences: int):
+    from chonkie import SemanticChunker
+    return SemanticChunker(
+        embedding_model=model,
+        threshold=threshold,
+        chunk_size=chunk_size,
+        min_sentences=min_sentences,
+    )
+
+
+def _get_chunker(model: str, threshold: float, chunk_size: int, min_sentences: int):
+    """
+    คืน SemanticChunker ที่โหลดโมเดลไว้แล้ว เพื่อไม่ต้องโหลดโมเดลใหม่ทุกไฟล์
+    """
+    with _chunker_lock:
+        return _load_chunker(model, threshold, chunk_size, min_sentences)
 
 
 def chunk_text_semantically(raw_text: str, source_file: str = "ไม่ระบุไฟล์", page_info: Dict[int, str] = None) -> List[Dict[str, any]]:
@@ -276,9 +414,12 @@ def chunk_text_semantically(raw_text: str, source_file: str = "ไม่ระ
     Returns:
         List[Dict] ที่มี text, source_file, page_number, chunk_id
     """
+    min_chars_keep = int(os.getenv("RAG_MIN_CHUNK_CHARS", "60"))
+    # ข้อความสั้นแบ่งตามย่อหน้าได้เลย ไม่คุ้มที่จะโหลดโมเดล embedding (การ map หน้าไม่ต้องใช้โมเดล)
+    if len(raw_text) < int(os.getenv("RAG_SEMCHUNK_MIN_CHARS", "2000")):
+        paragraphs = [p.strip() for p in raw_text.split("\n\n")]
+        return _normalize_chunks(paragraphs, source_file, page_info, min_chars_keep)
     try:
-        from chonkie import SemanticChunker
-        import os
         chunk_model = os.getenv(
             "RAG_CHUNK_EMBED_MODEL",
             os.getenv("RAG_EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"),
@@ -286,60 +427,50 @@ def chunk_text_semantically(raw_text: str, source_file: str = "ไม่ระ
         sim_threshold = float(os.getenv("RAG_CHUNK_SIM_THRESHOLD", "0.68"))
         chunk_size = int(os.getenv("RAG_CHUNK_SIZE", "128"))
         min_sentences = int(os.getenv("RAG_CHUNK_MIN_SENTENCES", "2"))
-        min_chars_keep = int(os.getenv("RAG_MIN_CHUNK_CHARS", "60"))
-        chunker = SemanticChunker(
-            embedding_model=chunk_model,
-            threshold=sim_threshold,
-            chunk_size=chunk_size,
-            min_sentences=min_sentences,
-        )
-        raw_chunks = chunker.chunk(raw_text)
-        chunks = []
-        for idx, ch in enumerate(raw_chunks):
-            text = ch["text"] if isinstance(ch, dict) else (ch if isinstance(ch, str) else getattr(ch, "text", ""))
-            if text and len(text.strip()) >= min_chars_keep:
-                chunks.append({"id": idx, "text": text})
-        normalized = []
-        for idx, ch in enumerate(chunks):
-            if isinstance(ch, dict) and "text" in ch:
-                text = ch["text"]
-            elif isinstance(ch, str):
-                text = ch
-            else:
-                text = getattr(ch, "text", None) or ""
-            if text.strip():
-                page_number = "ไม่ระบุหน้า"
-                if page_info:
-                    best_page = 1
-                    max_overlap = 0
-                    for page_num, page_text in page_info.items():
-                        chunk_words = set(text.lower().split())
-                        page_words = set(page_text.lower().split())
-                        overlap = len(chunk_words.intersection(page_words))
-                        if overlap > max_overlap:
-                            max_overlap = overlap
-                            best_page = page_num
-                    if max_overlap > 0:
-                        page_number = str(best_page)
-                
-                chunk_data = {
-                    "id": idx,
-                    "text": text,
-                    "source_file": source_file,
-                    "page_number": page_number,
-                    "chunk_id": f"{source_file}_{idx}"
-                }
-                normalized.append(chunk_data)
-        return normalized
+        chunker = _get_chunker(chunk_model, sim_threshold, chunk_size, min_sentences)
+        return _normalize_chunks(chunker.chunk(raw_text), source_file, page_info, min_chars_keep)
     except Exception:
-        parts = [p.strip() for p in raw_text.split("\n\n") if p.strip()]
-        return [{
-            "id": i, 
-            "text": p, 
+        return _paragraph_chunks(raw_text, source_file)
+
+
+def _normalize_chunks(raw_chunks, source_file: str, page_info: Optional[Dict[int, str]], min_chars_keep: int) -> List[Dict[str, any]]:
+    """
+    กรอง chunk ที่สั้นเกินไป แล้วใส่ metadata (หน้าที่ตรงที่สุด, chunk_id) ให้แต่ละ chunk
+    """
+    pages, token_pages = _build_page_index(page_info) if page_info else ([], {})
+    normalized = []
+    for ch in raw_chunks:
+        text = ch["text"] if isinstance(ch, dict) else (ch if isinstance(ch, str) else getattr(ch, "text", ""))
+        stripped_len = len(text.strip()) if text else 0
+        if not stripped_len or stripped_len < min_chars_keep:
+            continue
+        page_number = "ไม่ระบุหน้า"
+        if page_info:
+            best_page = _best_page(text, pages, token_pages)
+            if best_page is not None:
+                page_number = str(best_page)
+
+        idx = len(normalized)
+        normalized.append({
+            "id": idx,
+            "text": text,
             "source_file": source_file,
-            "page_number": "ไม่ระบุหน้า",
-            "chunk_id": f"{source_file}_{i}"
-        } for i, p in enumerate(parts)]
+            "page_number": page_number,
+            "chunk_id": f"{source_file}_{idx}"
+        })
+    return normalized
+
+
+def _paragraph_chunks(raw_text: str, source_file: str) -> List[Dict[str, any]]:
+    """แบ่ง chunks ตามย่อหน้า (บรรทัดว่าง) โดยไม่ใช้โมเดล"""
+    parts = [p.strip() for p in raw_text.split("\n\n") if p.strip()]
+    return [{
+        "id": i, 
+        "text": p, 
+        "source_file": source_file,
+        "page_number": "ไม่ระบุหน้า",
+        "chunk_id": f"{source_file}_{i}"
+    } for i, p in enumerate(parts)]
 
 
 def upload_chunks_to_qdrant(
@@ -348,7 +479,13 @@ def upload_chunks_to_qdrant(
     qdrant_url: str,
     qdrant_api_key: Optional[str] = None,
 ) -> str:
-    content_hash = hashlib.md5("\n".join([c.get("text", "") for c in chunks]).encode("utf-8")).hexdigest()
+    # hash แบบต่อเนื่องให้ผลเท่ากับ md5 ของข้อความที่ต่อด้วย "\n" โดยไม่ต้องสร้างสตริงรวม
+    digest = hashlib.md5()
+    for i, c in enumerate(chunks):
+        if i:
+            digest.update(b"\n")
+        digest.update(c.get("text", "").encode("utf-8"))
+    content_hash = digest.hexdigest()
     collection_name = f"doc_{collection_suffix}_{content_hash[:8]}"
     print(f"Connecting to Qdrant: {qdrant_url}")
     storage = QdrantStorage(
@@ -360,13 +497,21 @@ def upload_chunks_to_qdrant(
     print(f"Using collection: {storage.collection_name}")
     success = 0
     failed = 0
-    for ch in chunks:
+    for start in range(0, len(chunks), UPLOAD_BATCH_SIZE):
+        batch = chunks[start:start + UPLOAD_BATCH_SIZE]
         try:
-            storage.add(ch)
-            success += 1
+            # embed ทีละ batch ภายใน try เพื่อให้ความผิดพลาดนับเป็น failed แทนการหยุดทั้งไฟล์
+            vectors = storage.embedder.encode_batch([c['text'] for c in batch], batch_size=EMBED_BATCH_SIZE)
+            # รอเฉพาะ batch สุดท้าย เพื่อให้จำนวน points ด้านล่างเป็นค่าหลังอัปโหลดครบ
+            storage.add_batch(
+                batch,
+                vectors=vectors,
+                wait=start + UPLOAD_BATCH_SIZE >= len(chunks),
+            )
+            success += len(batch)
         except Exception as e:
-            failed += 1
-            print(f"Failed to upsert chunk id={ch.get('id')}: {e}")
+            failed += len(batch)
+            print(f"Failed to embed/upsert chunks {start}-{start + len(batch) - 1}: {e}")
     try:
         count_result = storage.client.count(storage.collection_name, exact=False)
         total = getattr(count_result, 'count', None)
@@ -381,6 +526,17 @@ def upload_chunks_to_qdrant(
     return storage.collection_name
 
 
+def _extract_and_chunk(full_path: str, filename: str, page_workers: Optional[int] = None) -> Tuple[str, Optional[List[Dict[str, any]]]]:
+    """
+    สกัดข้อความและแบ่ง chunks ของ PDF หนึ่งไฟล์ (รันใน worker process ได้)
+    คืน None แทน chunks เมื่อสกัดข้อความไม่ได้
+    """
+    raw_text, page_info = extract_text_from_pdf_with_metadata(full_path, max_workers=page_workers)
+    if not raw_text.strip():
+        return filename, None
+    return filename, chunk_text_semantically(raw_text, source_file=filename, page_info=page_info)
+
+
 def ingest_path_to_qdrant_with_metadata(
     path: str,
     collection_suffix: Optional[str] = None,
@@ -398,27 +554,37 @@ def ingest_path_to_qdrant_with_metadata(
     key = qdrant_api_key or os.getenv("QDRANT_API_KEY")
 
     if os.path.isdir(path):
-        created: List[str] = []
-        for filename in sorted(os.listdir(path)):
-            if not filename.lower().endswith(".pdf"):
-                continue
-            full_path = os.path.join(path, filename)
-            print(f"Processing: {filename}")
-            
-            raw_text, page_info = extract_text_from_pdf_with_metadata(full_path)
-            if not raw_text.strip():
+        pdfs = [filename for filename in sorted(os.listdir(path)) if filename.lower().endswith(".pdf")]
+        created: Dict[str, str] = {}
+
+        def upload(filename: str, chunks: Optional[List[Dict[str, any]]]) -> None:
+            if chunks is None:
                 print(f"No text extracted from {filename}. Skipping upload.")
-                continue
-            
-            chunks = chunk_text_semantically(raw_text, source_file=filename, page_info=page_info)
+                return
             print(f"{filename}: Chunked into {len(chunks)} segment(s)")
             base = os.path.splitext(os.path.basename(filename))[0]
-            safe = ''.join(ch if ch.isalnum() or ch in ['-', '_'] else '_' for ch in base)
+            safe = _SAFE_FN_RE.sub('_', base)
             suffix = collection_suffix or safe
             collection = upload_chunks_to_qdrant(chunks, suffix, url, key)
             print(collection)
-            created.append(collection)
-        return created[-1] if created else ""
+            created[filename] = collection
+
+        workers = min(_get_max_workers("files"), len(pdfs))
+        if workers > 1:
+            # สกัด+แบ่ง chunks หลายไฟล์พร้อมกัน ส่วน process หลักอัปโหลดทีละไฟล์ที่เสร็จ
+            # แต่ละไฟล์ใช้ 1 process เพื่อไม่ให้ซ้อน process pool ระดับหน้า
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = []
+                for filename in pdfs:
+                    print(f"Processing: {filename}")
+                    futures.append(executor.submit(_extract_and_chunk, os.path.join(path, filename), filename, 1))
+                for future in as_completed(futures):
+                    upload(*future.result())
+        else:
+            for filename in pdfs:
+                print(f"Processing: {filename}")
+                upload(*_extract_and_chunk(os.path.join(path, filename), filename))
+        return next((created[filename] for filename in reversed(pdfs) if filename in created), "")
     else:
         print(f"Processing: {path}")
         
@@ -448,14 +614,14 @@ def ingest_path_to_qdrant(
 
     if os.path.isdir(path):
         created: List[str] = []
-        for filename, raw_text in extract_texts_from_dir(path):
+        for filename, raw_text in iter_texts_from_dir(path):
             if not raw_text.strip():
                 print(f"No text extracted from {filename}. Skipping upload.")
                 continue
             chunks = chunk_text_semantically(raw_text, source_file=filename)
             print(f"{filename}: Chunked into {len(chunks)} segment(s)")
             base = os.path.splitext(os.path.basename(filename))[0]
-            safe = ''.join(ch if ch.isalnum() or ch in ['-', '_'] else '_' for ch in base)
+            safe = _SAFE_FN_RE.sub('_', base)
             suffix = collection_suffix or safe
             collection = upload_chunks_to_qdrant(chunks, suffix, url, key)
             print(collection)
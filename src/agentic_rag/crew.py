@@ -3,7 +3,12 @@ import yaml
 from .tools.custom_tool import DocumentSearchTool
 from .tools.qdrant_storage import QdrantStorage, MyEmbedder
 from langgraph.graph import StateGraph
+try:
+    from langgraph.config import get_stream_writer
+except ImportError:
+    get_stream_writer = None
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any
 from .tools.security_filter import SecurityFilter
 
@@ -19,7 +24,7 @@ LLAMA_CPP_BASE_URL = "http://localhost:8080/v1"
 AGENTS_YAML = os.path.join(os.path.dirname(__file__), 'config', 'agents.yaml')
 TASKS_YAML = os.path.join(os.path.dirname(__file__), 'config', 'tasks.yaml')
 
-def call_llm(prompt, system=None):
+def call_llm(prompt, system=None, on_token=None):
     if OpenAI is None:
         raise ImportError("OpenAI client not installed. Run: pip install openai")
     messages = []
@@ -27,12 +32,29 @@ def call_llm(prompt, system=None):
         messages.append({"role": "system", "content": system})
     messages.append({"role": "user", "content": prompt})
     client = OpenAI(base_url=LLAMA_CPP_BASE_URL, api_key="not-needed")
-    response = client.chat.completions.create(
+    if on_token is None:
+        response = client.chat.completions.create(
+            model=OLLAMA_MODEL,
+            messages=messages,
+            max_tokens=8192
+        )
+        return response.choices[0].message.content
+
+    stream = client.chat.completions.create(
         model=OLLAMA_MODEL,
         messages=messages,
-        max_tokens=8192
+        max_tokens=8192,
+        stream=True
     )
-    return response.choices[0].message.content
+    parts = []
+    for event in stream:
+        if not event.choices:
+            continue
+        delta = event.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            on_token(delta)
+    return "".join(parts)
 
 
 def build_langgraph_workflow(pdf_tool=None, use_knowledge_base=True, enable_refine: bool = True, single_answer_mode: bool = False):
@@ -245,64 +267,69 @@ def build_langgraph_workflow(pdf_tool=None, use_knowledge_base=True, enable_refi
         system = agents_config['answer_candidate_agent']['role'] + "\n" + agents_config['answer_candidate_agent']['goal']
 
         num_candidates = 1 if single_answer_mode else 3
-        candidates = []
-        for i in range(num_candidates):
-            source_info = ""
-            if search_metadata:
-                sources = []
-                for j, metadata in enumerate(search_metadata[:3]):
-                    source_file = metadata.get('source_file', 'ไม่ระบุไฟล์')
-                    page_number = metadata.get('page_number', 'ไม่ระบุหน้า')
-                    if source_file != 'ไม่ระบุไฟล์' and page_number != 'ไม่ระบุหน้า':
-                        sources.append(f"[{j+1}] {source_file}, หน้า {page_number}")
-                    elif source_file != 'ไม่ระบุไฟล์':
-                        sources.append(f"[{j+1}] {source_file}")
-                
-                if sources:
-                    source_info = f"\n\n📚 แหล่งที่มาของข้อมูล:\n" + "\n".join(sources)
+        source_info = ""
+        if search_metadata:
+            sources = []
+            for j, metadata in enumerate(search_metadata[:3]):
+                source_file = metadata.get('source_file', 'ไม่ระบุไฟล์')
+                page_number = metadata.get('page_number', 'ไม่ระบุหน้า')
+                if source_file != 'ไม่ระบุไฟล์' and page_number != 'ไม่ระบุหน้า':
+                    sources.append(f"[{j+1}] {source_file}, หน้า {page_number}")
+                elif source_file != 'ไม่ระบุไฟล์':
+                    sources.append(f"[{j+1}] {source_file}")
             
-            if conversation_context and conversation_context.strip():
-                prompt = (
-                    f"คำถาม: {refined}\n"
-                    f"ข้อมูลที่ค้นพบ: {retrieved_context}\n"
-                    f"บริบทการสนทนาก่อนหน้า: {conversation_context}\n"
-                    f"{source_info}\n"
-                    f"\nสร้างคำตอบที่:\n"
-                    f"- ตอบคำถามโดยตรงและครบถ้วน\n"
-                    f"- **สำคัญมาก**: วิเคราะห์คำถามเพื่อระบุแนวคิดหลัก (key concepts) ที่ควรมีในคำตอบ\n"
-                    f"- **สำคัญมาก**: ตรวจสอบให้แน่ใจว่าคำตอบครอบคลุมแนวคิดหลักทั้งหมด\n"
-                    f"- **ตัวอย่างแนวคิดหลัก**:\n"
-                    f"  * ถ้าถามเกี่ยวกับ 'ฐานกฎหมาย' ต้องรวม: ความยินยอม, สัญญา, หรือประโยชน์โดยชอบธรรม\n"
-                    f"  * ถ้าถามเกี่ยวกับ 'การแจ้งเหตุ' ต้องรวม: การประเมินเบื้องต้น, รายงานเท่าที่ทราบ\n"
-                    f"- ใช้ข้อมูลจากบริบทที่ให้มาเท่านั้น พร้อมสังเคราะห์ให้ถูกต้องตามหลักวิจัย/กฎหมาย\n"
-                    f"- ระบุหลักฐานตามมาตรา/หมวด PDPA ที่เกี่ยวข้อง\n"
-                    f"- ตอบให้ครบประเด็น ชัดเจน เข้าใจง่าย ใช้ภาษาไทย และใส่ emoji นำหน้าหัวข้อสำคัญ\n"
-                    f"- หากข้อมูลไม่เพียงพอ ให้บอกอย่างตรงไปตรงมาและระบุสิ่งที่ขาด\n"
-                    f"\n**ห้ามใส่คำแนะนำการจัดรูปแบบหรือคำสั่งใดๆ ในคำตอบ**\n"
-                )
-            else:
-                prompt = (
-                    f"คำถาม: {refined}\n"
-                    f"ข้อมูลที่ค้นพบ: {retrieved_context}\n"
-                    f"{source_info}\n"
-                    f"\nสร้างคำตอบที่:\n"
-                    f"- ตอบคำถามโดยตรงและครบถ้วน\n"
-                    f"- **สำคัญมาก**: วิเคราะห์คำถามเพื่อระบุแนวคิดหลัก (key concepts) ที่ควรมีในคำตอบ\n"
-                    f"- **สำคัญมาก**: ตรวจสอบให้แน่ใจว่าคำตอบครอบคลุมแนวคิดหลักทั้งหมด\n"
-                    f"- **ตัวอย่างแนวคิดหลัก**:\n"
-                    f"  * ถ้าถามเกี่ยวกับ 'ฐานกฎหมาย' ต้องรวม: ความยินยอม, สัญญา, หรือประโยชน์โดยชอบธรรม\n"
-                    f"  * ถ้าถามเกี่ยวกับ 'การแจ้งเหตุ' ต้องรวม: การประเมินเบื้องต้น, รายงานเท่าที่ทราบ\n"
-                    f"- ใช้ข้อมูลจากบริบทที่ให้มาเท่านั้น พร้อมสังเคราะห์ให้ถูกต้องตามหลักวิจัย/กฎหมาย\n"
-                    f"- ระบุหลักฐานตามมาตรา/หมวด PDPA ที่เกี่ยวข้อง\n"
-                    f"- ตอบให้ครบประเด็น ชัดเจน เข้าใจง่าย ใช้ภาษาไทย และใส่ emoji นำหน้าหัวข้อสำคัญ\n"
-                    f"- หากข้อมูลไม่เพียงพอ ให้บอกอย่างตรงไปตรงมาและระบุสิ่งที่ขาด\n"
-                    f"\n**ห้ามใส่คำแนะนำการจัดรูปแบบหรือคำสั่งใดๆ ในคำตอบ**\n"
-                )
+            if sources:
+                source_info = f"\n\n📚 แหล่งที่มาของข้อมูล:\n" + "\n".join(sources)
+        
+        if conversation_context and conversation_context.strip():
+            prompt = (
+                f"คำถาม: {refined}\n"
+                f"ข้อมูลที่ค้นพบ: {retrieved_context}\n"
+                f"บริบทการสนทนาก่อนหน้า: {conversation_context}\n"
+                f"{source_info}\n"
+                f"\nสร้างคำตอบที่:\n"
+                f"- ตอบคำถามโดยตรงและครบถ้วน\n"
+                f"- **สำคัญมาก**: วิเคราะห์คำถามเพื่อระบุแนวคิดหลัก (key concepts) ที่ควรมีในคำตอบ\n"
+                f"- **สำคัญมาก**: ตรวจสอบให้แน่ใจว่าคำตอบครอบคลุมแนวคิดหลักทั้งหมด\n"
+                f"- **ตัวอย่างแนวคิดหลัก**:\n"
+                f"  * ถ้าถามเกี่ยวกับ 'ฐานกฎหมาย' ต้องรวม: ความยินยอม, สัญญา, หรือประโยชน์โดยชอบธรรม\n"
+                f"  * ถ้าถามเกี่ยวกับ 'การแจ้งเหตุ' ต้องรวม: การประเมินเบื้องต้น, รายงานเท่าที่ทราบ\n"
+                f"- ใช้ข้อมูลจากบริบทที่ให้มาเท่านั้น พร้อมสังเคราะห์ให้ถูกต้องตามหลักวิจัย/กฎหมาย\n"
+                f"- ระบุหลักฐานตามมาตรา/หมวด PDPA ที่เกี่ยวข้อง\n"
+                f"- ตอบให้ครบประเด็น ชัดเจน เข้าใจง่าย ใช้ภาษาไทย และใส่ emoji นำหน้าหัวข้อสำคัญ\n"
+                f"- หากข้อมูลไม่เพียงพอ ให้บอกอย่างตรงไปตรงมาและระบุสิ่งที่ขาด\n"
+                f"\n**ห้ามใส่คำแนะนำการจัดรูปแบบหรือคำสั่งใดๆ ในคำตอบ**\n"
+            )
+        else:
+            prompt = (
+                f"คำถาม: {refined}\n"
+                f"ข้อมูลที่ค้นพบ: {retrieved_context}\n"
+                f"{source_info}\n"
+                f"\nสร้างคำตอบที่:\n"
+                f"- ตอบคำถามโดยตรงและครบถ้วน\n"
+                f"- **สำคัญมาก**: วิเคราะห์คำถามเพื่อระบุแนวคิดหลัก (key concepts) ที่ควรมีในคำตอบ\n"
+                f"- **สำคัญมาก**: ตรวจสอบให้แน่ใจว่าคำตอบครอบคลุมแนวคิดหลักทั้งหมด\n"
+                f"- **ตัวอย่างแนวคิดหลัก**:\n"
+                f"  * ถ้าถามเกี่ยวกับ 'ฐานกฎหมาย' ต้องรวม: ความยินยอม, สัญญา, หรือประโยชน์โดยชอบธรรม\n"
+                f"  * ถ้าถามเกี่ยวกับ 'การแจ้งเหตุ' ต้องรวม: การประเมินเบื้องต้น, รายงานเท่าที่ทราบ\n"
+                f"- ใช้ข้อมูลจากบริบทที่ให้มาเท่านั้น พร้อมสังเคราะห์ให้ถูกต้องตามหลักวิจัย/กฎหมาย\n"
+                f"- ระบุหลักฐานตามมาตรา/หมวด PDPA ที่เกี่ยวข้อง\n"
+                f"- ตอบให้ครบประเด็น ชัดเจน เข้าใจง่าย ใช้ภาษาไทย และใส่ emoji นำหน้าหัวข้อสำคัญ\n"
+                f"- หากข้อมูลไม่เพียงพอ ให้บอกอย่างตรงไปตรงมาและระบุสิ่งที่ขาด\n"
+                f"\n**ห้ามใส่คำแนะนำการจัดรูปแบบหรือคำสั่งใดๆ ในคำตอบ**\n"
+            )
+
+        def generate_candidate(i):
             try:
-                answer = call_llm(prompt, system=system).strip()
+                return call_llm(prompt, system=system).strip()
             except Exception as e:
-                answer = f"ไม่สามารถสร้างคำตอบลำดับที่ {i+1} ได้: {e}"
-            candidates.append(answer)
+                return f"ไม่สามารถสร้างคำตอบลำดับที่ {i+1} ได้: {e}"
+
+        if num_candidates > 1:
+            with ThreadPoolExecutor(max_workers=num_candidates) as executor:
+                candidates = list(executor.map(generate_candidate, range(num_candidates)))
+        else:
+            candidates = [generate_candidate(0)]
 
         if single_answer_mode:
             best_answer = candidates[0] if candidates else ""
@@ -368,12 +395,17 @@ def build_langgraph_workflow(pdf_tool=None, use_knowledge_base=True, enable_refi
         return {**state, "ranked": ranked, "candidates": ranked, "best_answer": best_answer, "progress_log": progress_log}
 
     def response_node(state):
+        if state.get("blocked"):
+            return {**state, "best_answer": state.get("response", "")}
+
         progress_log = append_progress(state, "🟡 [LangGraph] กำลังสรุปคำตอบ (Synthesizing response)...")
         ranked = state.get("ranked", [])
         best_answer = state.get("best_answer", "")
         conversation_context = state.get("context", "")
         refined = state.get("refined_question") or state.get("query", "")
         search_metadata = state.get("search_metadata", [])
+        writer = get_stream_writer() if get_stream_writer is not None else None
+        on_token = (lambda token: writer({"token": token})) if writer is not None else None
 
         if best_answer:
             system = agents_config['response_synthesizer_agent']['role'] + "\n" + agents_config['response_synthesizer_agent']['goal']
@@ -435,7 +467,7 @@ def build_langgraph_workflow(pdf_tool=None, use_knowledge_base=True, enable_refi
                     f"- ไม่เพิ่มข้อมูลใหม่ที่ไม่มีในคำตอบเดิม และใช้ภาษาไทย\n"
                     f"\n**ตอบเฉพาะเนื้อหาคำตอบเท่านั้น ไม่ต้องใส่คำแนะนำหรือคำสั่งใดๆ**\n"
                 )
-            response = call_llm(prompt, system=system)
+            response = call_llm(prompt, system=system, on_token=on_token)
         else:
             system = agents_config['response_synthesizer_agent']['role'] + "\n" + agents_config['response_synthesizer_agent']['goal']
             
@@ -465,13 +497,14 @@ def build_langgraph_workflow(pdf_tool=None, use_knowledge_base=True, enable_refi
                 f"- ใช้ภาษาที่เข้าใจง่ายและชัดเจน เป็นภาษาไทย\n"
                 f"\n**ตอบเฉพาะเนื้อหาคำตอบเท่านั้น ไม่ต้องใส่คำแนะนำหรือคำสั่งใดๆ**\n"
             )
-            response = call_llm(prompt, system=system)
+            response = call_llm(prompt, system=system, on_token=on_token)
 
         progress_log = append_progress({"progress_log": progress_log}, "🟢 [LangGraph] สรุปคำตอบเสร็จแล้ว (Response ready)")
+        # best_answer คือคำตอบสุดท้ายที่ใช้แสดงผลและบันทึกประวัติ
         return {
             **state, 
             "response": response, 
-            "best_answer": best_answer, 
+            "best_answer": (response or "").strip() or best_answer, 
             "search_metadata": search_metadata, 
             "progress_log": progress_log
         }
@@ -0,0 +1,115 @@
+from typing import Dict, Any, Optional, List, Tuple
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import (
+    PointStruct, VectorParams, Distance, Filter, FieldCondition, Range, FilterSelector, PayloadSchemaType,
+)
+from .qdrant_storage import MyEmbedder
+import os
+import uuid
+import time
+import json
+
+
+class AnswerCacheStore:
+    """
+    Qdrant-backed semantic cache of LangGraph workflow results.
+    - Keys each entry by the embedding of the user prompt (cosine distance)
+    - A top-1 hit above the similarity threshold returns the stored result
+    - Only the fields the chat renderer needs are stored, as JSON in the point payload
+    - Entries older than `ttl` seconds are never served and are pruned on store
+    - The collection is cleared once it grows past `max_entries` points
+    """
+
+    # ฟิลด์ของผลลัพธ์ที่หน้าแชทใช้แสดงผล (ไม่เก็บ progress_log และเนื้อหาเอกสาร)
+    RESULT_FIELDS = ("best_answer", "candidates", "candidate_metrics", "retrieval_source")
+    MAX_SOURCES = 5
+
+    def __init__(
+        self,
+        collection_name: str,
+        qdrant_url: str,
+        qdrant_api_key: Optional[str] = None,
+        embedder: Optional[MyEmbedder] = None,
+        threshold: float = 0.92,
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 5000,
+    ):
+        self.collection_name = collection_name
+        self.client = QdrantClient(url=qdrant_url, api_key=qdrant_api_key)
+        self.embedder = embedder or MyEmbedder(os.getenv("RAG_EMBED_MODEL"))
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._ensure_collection()
+
+    def _ensure_collection(self) -> None:
+        if not self.client.collection_exists(self.collection_name):
+            self.client.recreate_collection(
+                collection_name=self.collection_name,
+                vectors_config=VectorParams(size=self.embedder.vector_size, distance=Distance.COSINE),
+            )
+            self.client.create_payload_index(
+                collection_name=self.collection_name,
+                field_name="ts",
+                field_schema=PayloadSchemaType.FLOAT,
+            )
+
+    def _ts_filter(self, **bounds: float) -> Filter:
+        return Filter(must=[FieldCondition(key="ts", range=Range(**bounds))])
+
+    def _compact_result(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """ตัดผลลัพธ์ของ workflow ให้เหลือเฉพาะฟิลด์ที่ใช้แสดงผล"""
+        compact = {k: result[k] for k in self.RESULT_FIELDS if k in result}
+        sources = result.get("search_metadata") or []
+        if sources:
+            compact["search_metadata"] = [
+                {k: s[k] for k in ("source_file", "page_number") if k in s}
+                for s in sources[:self.MAX_SOURCES]
+                if isinstance(s, dict)
+            ]
+        return compact
+
+    def lookup(self, query: str) -> Tuple[Optional[Dict[str, Any]], List[float]]:
+        """
+        ค้นหาผลลัพธ์ที่เคยตอบแล้วสำหรับคำถามที่ใกล้เคียงกัน
+
+        Returns:
+            (result หรือ None ถ้าไม่พบ, vector ของคำถามสำหรับใช้ต่อใน store)
+        """
+        vector = self.embedder.encode(query)
+        hits = self.client.search(
+            collection_name=self.collection_name,
+            query_vector=vector,
+            limit=1,
+            with_payload=True,
+            score_threshold=self.threshold,
+            query_filter=self._ts_filter(gte=time.time() - self.ttl),
+        )
+        if hits and hits[0].payload:
+            try:
+                return json.loads(hits[0].payload.get("result", "")), vector
+            except (ValueError, TypeError):
+                pass
+        return None, vector
+
+    def store(self, vector: List[float], query: str, result: Dict[str, Any]) -> None:
+        """บันทึกผลลัพธ์ของ workflow โดยใช้ vector ของคำถามเป็นคีย์ แล้วลบรายการที่หมดอายุ/เกินขนาด"""
+        now = time.time()
+        payload = {
+            "query": query,
+            "result": json.dumps(self._compact_result(result), ensure_ascii=False, default=str),
+            "ts": now,
+        }
+        point = PointStruct(id=str(uuid.uuid4()), vector=vector, payload=payload)
+        self.client.upsert(collection_name=self.collection_name, points=[point])
+        self.client.delete(
+            collection_name=self.collection_name,
+            points_selector=FilterSelector(filter=self._ts_filter(lt=now - self.ttl)),
+        )
+        if self.client.count(self.collection_name, exact=True).count > self.max_entries:
+            self.clear()
+
+    def clear(self) -> None:
+        """ลบแคชคำตอบทั้งหมด"""
+        self.client.delete_collection(self.collection_name)
+        self._ensure_collection()
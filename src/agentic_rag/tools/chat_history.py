@@ -1,16 +1,21 @@
 from typing import List, Dict, Any, Optional, Tuple
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import PointStruct, Filter, FieldCondition, MatchValue, VectorParams, Distance, PayloadSchemaType
+from qdrant_client.http.models import PointStruct, Filter, FieldCondition, MatchValue, VectorParams, Distance, PayloadSchemaType, OrderBy, Direction
 import uuid
 import time
 import json
+from collections import Counter
+
+
+# จำนวน points ต่อการ scroll หนึ่งครั้งเมื่อต้องดึงประวัติทั้งเซสชัน
+_SCROLL_PAGE_SIZE = 1024
 
 
 class ChatHistoryStore:
     """
     Enhanced Qdrant-backed chat history with conversation context management.
     - Uses a tiny 1-dim dummy vector [0.0] for compatibility
-    - Filters by session_id; sorts by timestamp client-side
+    - Filters by session_id; orders by the indexed timestamp server-side
     - Supports conversation context building and memory management
     """
 
@@ -26,15 +31,16 @@ class ChatHistoryStore:
                 vectors_config=VectorParams(size=1, distance=Distance.COSINE),
             )
       
-        try:
-            self.client.create_payload_index(
-                collection_name=self.collection_name,
-                field_name="session_id",
-                field_schema=PayloadSchemaType.KEYWORD,
-            )
-        except Exception:
-            
-            pass
+        for field_name, field_schema in (("session_id", PayloadSchemaType.KEYWORD), ("ts", PayloadSchemaType.FLOAT)):
+            try:
+                self.client.create_payload_index(
+                    collection_name=self.collection_name,
+                    field_name=field_name,
+                    field_schema=field_schema,
+                )
+            except Exception:
+                
+                pass
 
     def add_message(self, session_id: str, role: str, content: str, ts: Optional[float] = None, extra: Optional[Dict[str, Any]] = None) -> None:
         """เพิ่มข้อความใหม่ลงในประวัติการสนทนา"""
@@ -54,10 +60,35 @@ class ChatHistoryStore:
         )
         self.client.upsert(collection_name=self.collection_name, points=[point])
 
-    def list_messages(self, session_id: str, limit: int = 500) -> List[Dict[str, Any]]:
-        """ดึงรายการข้อความทั้งหมดในเซสชัน"""
+    def list_messages(self, session_id: str, limit: int = 500, order: str = "asc", offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        ดึงรายการข้อความในเซสชันแบบแบ่งหน้า
+        
+        Args:
+            session_id: ID ของเซสชันการสนทนา
+            limit: จำนวนข้อความสูงสุดที่ต้องการ (0 = ทั้งหมด)
+            order: "asc" เรียงจากเก่าไปใหม่, "desc" เรียงจากใหม่ไปเก่า
+            offset: จำนวนข้อความที่ข้ามไปก่อน ตามลำดับที่เลือก
+            
+        Returns:
+            รายการ payload ของข้อความ
+        """
       
         flt = Filter(must=[FieldCondition(key="session_id", match=MatchValue(value=session_id))])
+        if limit:
+            # ให้ Qdrant เรียงตาม ts และตัดจำนวนให้เลย ไม่ต้องดึงประวัติทั้งหมด
+            try:
+                points, _ = self.client.scroll(
+                    collection_name=self.collection_name,
+                    scroll_filter=flt,
+                    with_payload=True,
+                    with_vectors=False,
+                    limit=offset + limit,
+                    order_by=OrderBy(key="ts", direction=Direction.DESC if order == "desc" else Direction.ASC),
+                )
+                return [p.payload for p in points if p.payload][offset:]
+            except Exception:
+                pass
         all_payloads: List[Dict[str, Any]] = []
         next_page = None
         while True:
@@ -66,17 +97,22 @@ class ChatHistoryStore:
                 scroll_filter=flt,
                 with_payload=True,
                 with_vectors=False,
-                limit=min(256, limit - len(all_payloads)) if limit else 256,
+                limit=_SCROLL_PAGE_SIZE,
                 offset=next_page,
             )
             points, next_page = result
             for p in points:
                 if p.payload:
                     all_payloads.append(p.payload)
-            if not next_page or (limit and len(all_payloads) >= limit):
+            if not next_page:
                 break
-        all_payloads.sort(key=lambda x: x.get("ts", 0.0))
-        return all_payloads[:limit] if limit else all_payloads
+        all_payloads.sort(key=lambda x: x.get("ts", 0.0), reverse=(order == "desc"))
+        return all_payloads[offset:offset + limit] if limit else all_payloads[offset:]
+
+    def count_messages(self, session_id: str) -> int:
+        """นับจำนวนข้อความทั้งหมดในเซสชัน"""
+        flt = Filter(must=[FieldCondition(key="session_id", match=MatchValue(value=session_id))])
+        return self.client.count(collection_name=self.collection_name, count_filter=flt, exact=True).count
 
     def get_conversation_context(self, session_id: str, max_turns: int = 5, max_chars: int = 4000) -> str:
         """
@@ -90,7 +126,7 @@ class ChatHistoryStore:
         Returns:
             บริบทการสนทนาในรูปแบบข้อความ
         """
-        messages = self.list_messages(session_id, limit=max_turns * 2)
+        messages = self.list_messages(session_id, limit=max_turns * 2, order="desc")
         
         if not messages:
             return ""
@@ -99,11 +135,8 @@ class ChatHistoryStore:
         context_parts = []
         char_count = 0
         
-       
-        messages.sort(key=lambda x: x.get("ts", 0.0))
-        
-      
-        for message in reversed(messages):
+        # messages เรียงจากใหม่ไปเก่าอยู่แล้ว เก็บแบบ append แล้วกลับลำดับครั้งเดียวตอนท้าย
+        for message in messages:
             role = message.get("role", "")
             content = message.get("content", "")
             
@@ -118,9 +151,10 @@ class ChatHistoryStore:
             if char_count + len(context_line) > max_chars:
                 break
                 
-            context_parts.insert(0, context_line)  
+            context_parts.append(context_line)
             char_count += len(context_line)
         
+        context_parts.reverse()
         return "\n".join(context_parts)
 
     def get_recent_context(self, session_id: str, last_n_messages: int = 6) -> List[Dict[str, Any]]:
@@ -134,8 +168,9 @@ class ChatHistoryStore:
         Returns:
             รายการข้อความล่าสุด
         """
-        messages = self.list_messages(session_id, limit=last_n_messages)
-        return messages[-last_n_messages:] if len(messages) > last_n_messages else messages
+        messages = self.list_messages(session_id, limit=last_n_messages, order="desc")
+        messages.reverse()
+        return messages
 
     def build_conversation_prompt(self, session_id: str, current_query: str, max_turns: int = 3) -> str:
         """
@@ -172,14 +207,13 @@ class ChatHistoryStore:
         """ดึงสถิติของเซสชันการสนทนา"""
         messages = self.list_messages(session_id)
         
-        user_messages = [m for m in messages if m.get("role") == "user"]
-        assistant_messages = [m for m in messages if m.get("role") == "assistant"]
+        roles = Counter(m.get("role") for m in messages)
         
         return {
             "total_messages": len(messages),
-            "user_messages": len(user_messages),
-            "assistant_messages": len(assistant_messages),
-            "conversation_turns": min(len(user_messages), len(assistant_messages)),
+            "user_messages": roles["user"],
+            "assistant_messages": roles["assistant"],
+            "conversation_turns": min(roles["user"], roles["assistant"]),
             "session_duration": messages[-1].get("ts", 0) - messages[0].get("ts", 0) if messages else 0
         }
 
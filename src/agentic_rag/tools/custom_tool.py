@@ -5,10 +5,18 @@ from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from dotenv import load_dotenv
 import hashlib
+import heapq
+import sqlite3
+import tempfile
+import threading
 import time
+import weakref
 import gc
 import traceback
 import logging
+import multiprocessing
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from .qdrant_storage import QdrantStorage, MyEmbedder
 try:
     import pdfplumber
@@ -35,6 +43,81 @@ logger = logging.getLogger("DocumentSearchTool")
 
 load_dotenv()
 
+# ตัดข้อความก่อนจับคู่กับคำถาม เพื่อจำกัดความยาว sequence ของ cross-encoder
+_RERANK_BATCH_SIZE = 32
+_RERANK_MAX_LENGTH = 512
+_RERANK_MAX_CHARS = 2000
+
+# โมเดล rerank ค่าเริ่มต้น: bge-reranker-v2-m3 บน GPU, multilingual MiniLM ที่เล็กกว่ามากบน CPU
+_RERANKER_MODEL_GPU = "BAAI/bge-reranker-v2-m3"
+_RERANKER_MODEL_CPU = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+# จำนวน process สูงสุดสำหรับอ่าน PDF ของ fallback (เว้นหนึ่ง core ให้ server)
+_FALLBACK_MAX_WORKERS = int(os.getenv("RAG_FALLBACK_MAX_WORKERS", "0")) or max(1, (os.cpu_count() or 2) - 1)
+
+
+def _fallback_mp_context():
+    """
+    context สำหรับ worker ของ fallback: ไม่ fork จาก server ที่มีหลาย thread และถือโมเดล torch อยู่
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+def _split_text(text: str, chunk_size: int = 900, overlap: int = 200) -> List[str]:
+    """
+    แบ่งข้อความเป็นชิ้นขนาดคงที่เพื่อใช้ค้นหาแบบง่าย
+    """
+    cleaned = text.strip()
+    if not cleaned:
+        return []
+
+    chunks = []
+    start = 0
+    length = len(cleaned)
+    while start < length:
+        end = min(start + chunk_size, length)
+        chunks.append(cleaned[start:end])
+        if end == length:
+            break
+        start = max(0, end - overlap)
+    return chunks
+
+
+def _extract_pdf_chunks(pdf_path: Path) -> List[Dict[str, any]]:
+    """
+    อ่าน PDF หนึ่งไฟล์เป็น chunk สำหรับค้นหาแบบ lexical (รันใน worker process ได้)
+    """
+    chunks: List[Dict[str, any]] = []
+    try:
+        with pdfplumber.open(str(pdf_path)) as pdf:
+            for idx, page in enumerate(pdf.pages):
+                text = page.extract_text() or ""
+                if not text.strip():
+                    continue
+                for piece in _split_text(text, chunk_size=900, overlap=200):
+                    chunks.append(
+                        {
+                            "text": piece,
+                            "text_lower": piece.lower(),
+                            "source_file": pdf_path.name,
+                            "page_number": idx + 1,
+                            "collection_name": "fallback_pdf",
+                            "score": 0.0,
+                        }
+                    )
+    except Exception as e:
+        logger.warning(f"Cannot read PDF {pdf_path}: {e}")
+    return chunks
+
+
+def _drop_fallback_db(db: sqlite3.Connection, db_path: str) -> None:
+    """ปิดและลบไฟล์ SQLite ที่เก็บ chunk สำรอง"""
+    try:
+        db.close()
+        os.remove(db_path)
+    except Exception:
+        pass
 
 
 class DocumentSearchToolInput(BaseModel):
@@ -70,10 +153,18 @@ class DocumentSearchTool(object):
         self.search_all_collections = True
         self.vector_db = None
 
-        self.fallback_chunks: List[Dict[str, any]] = []
+        # chunk สำรองเก็บในไฟล์ SQLite ชั่วคราว แทนการถือทั้งหมดไว้ในหน่วยความจำ
+        self.fallback_db: Optional[sqlite3.Connection] = None
+        self.fallback_count = 0
+        self.fallback_lock = threading.Lock()
         self.fallback_loaded = False
 
-        self.query_cache = {} 
+        # tool ตัวเดียวถูกใช้ร่วมกันทุกเซสชันของ Streamlit (หลาย thread) จึงต้องล็อกแคช
+        self.cache_lock = threading.Lock()
+        self.query_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self.query_cache_size = 1024
+        self.embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.embedding_cache_size = 512
         self.last_cache_cleanup = time.time()
         self.cache_ttl = 3600  
         self.last_gc_time = time.time()
@@ -82,12 +173,18 @@ class DocumentSearchTool(object):
  
         self.reranker = None
         self.use_reranker = RERANKER_AVAILABLE and os.getenv("RAG_USE_RERANKER", "1").lower() in ("1", "true", "yes", "y")
+        self.rerank_topk = int(os.getenv("RAG_RERANK_TOPK", "50"))
         if self.use_reranker:
             try:
-                self.reranker = CrossEncoder('BAAI/bge-reranker-v2-m3')
-                logger.info("BGE reranker initialized successfully using CrossEncoder")
+                import torch
+                use_cuda = torch.cuda.is_available()
+                reranker_model = os.getenv("RAG_RERANKER_MODEL") or (_RERANKER_MODEL_GPU if use_cuda else _RERANKER_MODEL_CPU)
+                self.reranker = CrossEncoder(reranker_model, max_length=_RERANK_MAX_LENGTH)
+                if use_cuda:
+                    self.reranker.model.half()
+                logger.info(f"Reranker initialized successfully using CrossEncoder ({reranker_model})")
             except Exception as e:
-                logger.warning(f"Failed to initialize BGE reranker: {e}")
+                logger.warning(f"Failed to initialize reranker: {e}")
                 self.use_reranker = False
                 self.reranker = None
         else:
@@ -246,14 +343,18 @@ class DocumentSearchTool(object):
             try:
                 self._cleanup_cache()
                 cache_key = self._get_cache_key((query or "") + (context or ""))
-                if cache_key in self.query_cache:
-                    timestamp, result = self.query_cache[cache_key]
-                    if time.time() - timestamp <= self.cache_ttl:
-                        return result
+                with self.cache_lock:
+                    cached = self.query_cache.get(cache_key)
+                    if cached is not None:
+                        timestamp, result = cached
+                        if time.time() - timestamp <= self.cache_ttl:
+                            self.query_cache.move_to_end(cache_key)
+                            return result
+                        self.query_cache.pop(cache_key, None)
 
                 search_query = self._process_thai_text(query)
                 if search_query:
-                    vector = self.embedder.encode(search_query)
+                    vector = self._get_query_embedding(search_query)
                     qc = self.vector_db.client
                     cols_resp = qc.get_collections()
                     collections = getattr(cols_resp, 'collections', [])
@@ -261,45 +362,23 @@ class DocumentSearchTool(object):
                     searched_cols: List[str] = []
 
                     if collections:
-                        for col in collections:
-                            collection_name = getattr(col, 'name', None) or (col.get('name') if isinstance(col, dict) else None)
-                            if not collection_name:
-                                continue
-                            try:
-                                search_result = qc.search(
-                                    collection_name=collection_name,
-                                    query_vector=vector,
-                                    limit=5,
-                                    with_payload=True,
+                        collection_names = [
+                            name for name in (
+                                getattr(col, 'name', None) or (col.get('name') if isinstance(col, dict) else None)
+                                for col in collections
+                            ) if name
+                        ]
+                        if collection_names:
+                            # ค้นทุก collection พร้อมกัน (งาน I/O) แล้วรวมผลตามลำดับเดิม
+                            with ThreadPoolExecutor(max_workers=min(8, len(collection_names))) as executor:
+                                per_collection = executor.map(
+                                    lambda name: self._search_collection(qc, name, vector),
+                                    collection_names,
                                 )
-                                searched_cols.append(collection_name)
-                                for point in search_result:
-                                    payload = getattr(point, 'payload', None) or (point.get('payload') if isinstance(point, dict) else None)
-                                    if isinstance(payload, dict):
-                                        text_val = payload.get('text')
-                                        if text_val:
-                                            chunk_data = {
-                                                'text': text_val,
-                                                'source_file': payload.get('source_file', 'ไม่ระบุไฟล์'),
-                                                'page_number': payload.get('page_number', 'ไม่ระบุหน้า'),
-                                                'chunk_id': payload.get('chunk_id', 'ไม่ระบุ'),
-                                                'collection_name': collection_name,
-                                                'score': getattr(point, 'score', 0.0) if hasattr(point, 'score') else 0.0
-                                            }
-                                            aggregated_results.append(chunk_data)
-                                    elif isinstance(payload, str):
-                                        chunk_data = {
-                                            'text': payload,
-                                            'source_file': 'ไม่ระบุไฟล์',
-                                            'page_number': 'ไม่ระบุหน้า',
-                                            'chunk_id': 'ไม่ระบุ',
-                                            'collection_name': collection_name,
-                                            'score': 0.0
-                                        }
-                                        aggregated_results.append(chunk_data)
-                            except Exception as e:
-                                logger.warning(f"Could not search in collection '{collection_name}': {e}")
-                                continue
+                                for collection_name, chunks in zip(collection_names, per_collection):
+                                    if chunks is not None:
+                                        searched_cols.append(collection_name)
+                                        aggregated_results.extend(chunks)
 
                         if searched_cols:
                             logger.info(f"Qdrant searched in {len(searched_cols)} collections: {', '.join(searched_cols)}")
@@ -307,11 +386,17 @@ class DocumentSearchTool(object):
                  
                     if aggregated_results and self.use_reranker:
                         try:
-                            aggregated_results = self._rerank_results(search_query, aggregated_results, top_k=10)
+                            # คัดผู้สมัครตามคะแนน vector ก่อน เพื่อจำกัดงานของ reranker ไม่ว่าจะมีกี่ collection
+                            candidates = sorted(aggregated_results, key=lambda x: x.get('score', 0.0), reverse=True)[:self.rerank_topk]
+                            aggregated_results = self._rerank_results(search_query, candidates, top_k=10)
                         except Exception as e:
                             logger.warning(f"Reranking failed, using original results: {e}")
 
-                    self.query_cache[cache_key] = (time.time(), aggregated_results)
+                    with self.cache_lock:
+                        self.query_cache[cache_key] = (time.time(), aggregated_results)
+                        self.query_cache.move_to_end(cache_key)
+                        while len(self.query_cache) > self.query_cache_size:
+                            self.query_cache.popitem(last=False)
                     if aggregated_results:
                         return aggregated_results
             except Exception as e:
@@ -325,6 +410,64 @@ class DocumentSearchTool(object):
 
         return []
 
+    def _get_query_embedding(self, search_query: str) -> List[float]:
+        """
+        คืน embedding ของคำถาม โดยใช้ซ้ำถ้าเคยคำนวณแล้ว (คำถามเดิมที่ context ต่างกันไม่ต้อง encode ใหม่)
+        """
+        key = self._get_cache_key(search_query)
+        with self.cache_lock:
+            vector = self.embedding_cache.get(key)
+            if vector is not None:
+                self.embedding_cache.move_to_end(key)
+                return vector
+        vector = self.embedder.encode(search_query)
+        with self.cache_lock:
+            self.embedding_cache[key] = vector
+            self.embedding_cache.move_to_end(key)
+            while len(self.embedding_cache) > self.embedding_cache_size:
+                self.embedding_cache.popitem(last=False)
+        return vector
+
+    def _search_collection(self, qc, collection_name: str, vector) -> Optional[List[Dict[str, any]]]:
+        """
+        ค้นหาใน collection เดียว คืน None ถ้าค้นหาไม่สำเร็จ
+        """
+        try:
+            search_result = qc.search(
+                collection_name=collection_name,
+                query_vector=vector,
+                limit=5,
+                with_payload=True,
+            )
+        except Exception as e:
+            logger.warning(f"Could not search in collection '{collection_name}': {e}")
+            return None
+
+        chunks: List[Dict[str, any]] = []
+        for point in search_result:
+            payload = getattr(point, 'payload', None) or (point.get('payload') if isinstance(point, dict) else None)
+            if isinstance(payload, dict):
+                text_val = payload.get('text')
+                if text_val:
+                    chunks.append({
+                        'text': text_val,
+                        'source_file': payload.get('source_file', 'ไม่ระบุไฟล์'),
+                        'page_number': payload.get('page_number', 'ไม่ระบุหน้า'),
+                        'chunk_id': payload.get('chunk_id', 'ไม่ระบุ'),
+                        'collection_name': collection_name,
+                        'score': getattr(point, 'score', 0.0) if hasattr(point, 'score') else 0.0
+                    })
+            elif isinstance(payload, str):
+                chunks.append({
+                    'text': payload,
+                    'source_file': 'ไม่ระบุไฟล์',
+                    'page_number': 'ไม่ระบุหน้า',
+                    'chunk_id': 'ไม่ระบุ',
+                    'collection_name': collection_name,
+                    'score': 0.0
+                })
+        return chunks
+
     def _fallback_search(self, query: str) -> List[Dict[str, any]]:
         """
         ค้นหาแบบง่ายจากไฟล์ PDF (lexical) กรณี Qdrant ใช้ไม่ได้หรือไม่มีข้อมูล
@@ -333,30 +476,43 @@ class DocumentSearchTool(object):
             return []
 
         try:
-            if not self.fallback_loaded:
-                self._load_fallback_chunks()
+            # โหลดครั้งเดียวภายใต้ล็อก เพื่อไม่ให้หลาย thread สร้าง process pool/ไฟล์ SQLite ซ้อนกัน
+            with self.fallback_lock:
+                if not self.fallback_loaded:
+                    self._load_fallback_chunks()
 
             processed_query = (query or "").strip()
-            if not processed_query or not self.fallback_chunks:
+            if not processed_query or not self.fallback_count:
                 return []
 
             q_lower = processed_query.lower()
+            # ตัดคำและแปลงตัวพิมพ์เล็กของคำถามครั้งเดียวต่อคำถาม คำซ้ำนับตามจำนวนครั้งเหมือนเดิม
+            query_tokens = Counter(tok.lower() for tok in processed_query.split())
 
-            def score_chunk(text: str) -> float:
-                t = text.lower()
+            def score_chunk(t: str) -> float:
                 hit = t.count(q_lower)
-                token_hits = sum(1 for tok in processed_query.split() if tok and tok.lower() in t)
+                token_hits = sum(n for tok, n in query_tokens.items() if tok in t)
                 return float(hit * 2 + token_hits)
 
-            scored = []
-            for chunk in self.fallback_chunks:
-                txt = chunk.get("text", "")
-                sc = score_chunk(txt)
-                if sc > 0:
-                    scored.append((sc, chunk))
-
-            scored.sort(key=lambda x: x[0], reverse=True)
-            top = [dict(item[1], rerank_score=item[0]) for item in scored[:5]]
+            with self.fallback_lock:
+                # อ่านทีละแถวและเก็บเฉพาะ 5 อันดับแรก (nlargest คงลำดับเดิมเมื่อคะแนนเท่ากัน)
+                rows = self.fallback_db.execute("SELECT rowid, text_lower FROM chunks ORDER BY rowid")
+                scored = ((score_chunk(text_lower), rowid) for rowid, text_lower in rows)
+                best = heapq.nlargest(5, ((sc, rowid) for sc, rowid in scored if sc > 0), key=lambda x: x[0])
+
+                top = []
+                for sc, rowid in best:
+                    text, source_file, page_number = self.fallback_db.execute(
+                        "SELECT text, source_file, page_number FROM chunks WHERE rowid = ?", (rowid,)
+                    ).fetchone()
+                    top.append({
+                        "text": text,
+                        "source_file": source_file,
+                        "page_number": page_number,
+                        "collection_name": "fallback_pdf",
+                        "score": 0.0,
+                        "rerank_score": sc,
+                    })
             return top
         except Exception as e:
             logger.warning(f"Fallback PDF search failed: {e}")
@@ -365,6 +521,7 @@ class DocumentSearchTool(object):
     def _load_fallback_chunks(self):
         """
         โหลดเนื้อหาจาก PDF เป็นชิ้น (chunk) ง่ายๆ เพื่อใช้ค้นหาแบบ lexical
+        (ผู้เรียกต้องถือ fallback_lock)
         """
         if self.fallback_loaded:
             return
@@ -380,50 +537,39 @@ class DocumentSearchTool(object):
             self.fallback_loaded = True
             return
 
-        chunks: List[Dict[str, any]] = []
-        for pdf_path in pdf_files:
-            try:
-                with pdfplumber.open(str(pdf_path)) as pdf:
-                    for idx, page in enumerate(pdf.pages):
-                        text = page.extract_text() or ""
-                        if not text.strip():
-                            continue
-                        for piece in self._split_to_chunks(text, chunk_size=900, overlap=200):
-                            chunks.append(
-                                {
-                                    "text": piece,
-                                    "source_file": pdf_path.name,
-                                    "page_number": idx + 1,
-                                    "collection_name": "fallback_pdf",
-                                    "score": 0.0,
-                                }
-                            )
-            except Exception as e:
-                logger.warning(f"Cannot read PDF {pdf_path}: {e}")
-                continue
+        fd, db_path = tempfile.mkstemp(prefix="fallback_chunks_", suffix=".sqlite3")
+        os.close(fd)
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        weakref.finalize(self, _drop_fallback_db, db, db_path)
+        db.execute("CREATE TABLE chunks (text TEXT, text_lower TEXT, source_file TEXT, page_number INTEGER)")
+
+        def store(file_chunks: List[Dict[str, any]]) -> int:
+            db.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                ((c["text"], c["text_lower"], c["source_file"], c["page_number"]) for c in file_chunks),
+            )
+            return len(file_chunks)
+
+        # pdfplumber สกัดข้อความด้วย Python ล้วน จึงแยกไฟล์ไปทำใน process ละไฟล์
+        # และเขียนลง SQLite ทีละไฟล์ตามลำดับ จึงถือ chunk ในหน่วยความจำครั้งละไฟล์เดียว
+        workers = min(_FALLBACK_MAX_WORKERS, len(pdf_files))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=_fallback_mp_context()) as executor:
+                count = sum(store(file_chunks) for file_chunks in executor.map(_extract_pdf_chunks, pdf_files))
+        else:
+            count = sum(store(_extract_pdf_chunks(pdf_path)) for pdf_path in pdf_files)
+        db.commit()
 
-        self.fallback_chunks = chunks
+        self.fallback_db = db
+        self.fallback_count = count
         self.fallback_loaded = True
-        logger.info(f"Fallback PDF chunks loaded: {len(self.fallback_chunks)}")
+        logger.info(f"Fallback PDF chunks loaded: {self.fallback_count}")
 
     def _split_to_chunks(self, text: str, chunk_size: int = 900, overlap: int = 200) -> List[str]:
         """
         แบ่งข้อความเป็นชิ้นขนาดคงที่เพื่อใช้ค้นหาแบบง่าย
         """
-        cleaned = text.strip()
-        if not cleaned:
-            return []
-
-        chunks = []
-        start = 0
-        length = len(cleaned)
-        while start < length:
-            end = min(start + chunk_size, length)
-            chunks.append(cleaned[start:end])
-            if end == length:
-                break
-            start = max(0, end - overlap)
-        return chunks
+        return _split_text(text, chunk_size=chunk_size, overlap=overlap)
 
     def get_search_results_with_metadata(self, query: str, context: Optional[str] = None) -> List[Dict[str, any]]:
         """
@@ -522,7 +668,9 @@ class DocumentSearchTool(object):
         try:
          
             self.image_cache.clear()
-            self.query_cache.clear()
+            with self.cache_lock:
+                self.query_cache.clear()
+                self.embedding_cache.clear()
             
      
             self.raw_text = ""
@@ -540,17 +688,17 @@ class DocumentSearchTool(object):
     def _cleanup_cache(self):
         """
         ลบแคชที่หมดอายุเพื่อป้องกันการใช้หน่วยความจำมากเกินไป
+        (ตัดเฉพาะรายการที่ใช้ล่าสุดนานที่สุดจากหัวคิว รายการอื่นตรวจ TTL ตอนค้นหา)
         """
         try:
             current_time = time.time()
             if current_time - self.last_cache_cleanup > 300: 
-                expired_keys = []
-                for key, (timestamp, _) in self.query_cache.items():
-                    if current_time - timestamp > self.cache_ttl:
-                        expired_keys.append(key)
-                
-                for key in expired_keys:
-                    del self.query_cache[key]
+                with self.cache_lock:
+                    while self.query_cache:
+                        timestamp, _ = next(iter(self.query_cache.values()))
+                        if current_time - timestamp <= self.cache_ttl:
+                            break
+                        self.query_cache.popitem(last=False)
                 
                 self.last_cache_cleanup = current_time
         except Exception as e:
@@ -560,7 +708,7 @@ class DocumentSearchTool(object):
         """
         สร้างคีย์สำหรับแคชจากคำถาม
         """
-        return hashlib.md5(query.encode()).hexdigest()
+        return hashlib.blake2b(query.encode('utf-8'), digest_size=16).hexdigest()
 
     def _process_thai_text(self, text: str) -> str:
         """
@@ -570,7 +718,7 @@ class DocumentSearchTool(object):
 
     def _rerank_results(self, query: str, search_results: List[Dict[str, any]], top_k: int = 10) -> List[Dict[str, any]]:
         """
-        Rerank search results using BGE reranker
+        Rerank search results using the cross-encoder reranker
         """
         if not self.use_reranker or not self.reranker or not search_results:
             return search_results[:top_k]
@@ -581,13 +729,18 @@ class DocumentSearchTool(object):
             for result in search_results:
                 text = result.get('text', '')
                 if text:
-                    pairs.append([query, text])
+                    pairs.append([query, text[:_RERANK_MAX_CHARS]])
             
             if not pairs:
                 return search_results[:top_k]
             
            
-            scores = self.reranker.predict(pairs)
+            scores = self.reranker.predict(
+                pairs,
+                batch_size=_RERANK_BATCH_SIZE,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+            )
             
         
             import numpy as np
@@ -616,7 +769,7 @@ class DocumentSearchTool(object):
          
             reranked_results.sort(key=lambda x: x.get('rerank_score', 0), reverse=True)
             
-            logger.info(f"Reranked {len(reranked_results)} results using BGE reranker")
+            logger.info(f"Reranked {len(reranked_results)} results using cross-encoder reranker")
             return reranked_results[:top_k]
             
         except Exception as e:
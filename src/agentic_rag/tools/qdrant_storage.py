@@ -13,6 +13,9 @@ class MyEmbedder:
     def encode(self, text: str):
         return self.model.encode(text).tolist()
 
+    def encode_batch(self, texts: List[str], batch_size: int = 32):
+        return self.model.encode(list(texts), batch_size=batch_size, show_progress_bar=False).tolist()
+
 class QdrantStorage:
     """
     Handles embeddings for memory entries using Qdrant.
@@ -55,22 +58,31 @@ class QdrantStorage:
 
     def add(self, chunk: dict):
         vector = self.embedder.encode(chunk['text'])
-        point_id = chunk.get('id')
-  
-        if isinstance(point_id, int):
-            valid_id = point_id
-        else:
-            stable_hash = self._generate_id(chunk)
-            valid_id = str(uuid.UUID(hex=stable_hash[:32]))
         self.client.upsert(
             collection_name=self.collection_name,
             points=[PointStruct(
-                id=valid_id,
+                id=self._point_id(chunk),
                 vector=vector,
                 payload=chunk
             )]
         )
 
+    def add_batch(self, chunks: List[dict], vectors: Optional[List[List[float]]] = None, wait: bool = True):
+        """
+        Upserts several chunks in a single request, embedding them together
+        unless precomputed vectors are given.
+        """
+        if vectors is None:
+            vectors = self.embedder.encode_batch([c['text'] for c in chunks])
+        self.client.upsert(
+            collection_name=self.collection_name,
+            points=[
+                PointStruct(id=self._point_id(c), vector=v, payload=c)
+                for c, v in zip(chunks, vectors)
+            ],
+            wait=wait,
+        )
+
     def search(
         self,
         query: str,
@@ -97,6 +109,14 @@ class QdrantStorage:
         self.client.delete_collection(self.collection_name)
         self._ensure_collection()
 
+    def _point_id(self, chunk: dict):
+        point_id = chunk.get('id')
+  
+        if isinstance(point_id, int):
+            return point_id
+        stable_hash = self._generate_id(chunk)
+        return str(uuid.UUID(hex=stable_hash[:32]))
+
     def _generate_id(self, chunk: dict) -> str:
         return hashlib.sha1(chunk['text'].encode('utf-8')).hexdigest()
 
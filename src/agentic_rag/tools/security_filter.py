@@ -154,6 +154,8 @@ class SecurityFilter:
         ]
         self.injection_regex = re.compile('|'.join(self.injection_phrases), re.IGNORECASE)
 
+        self.suspicious_regex = re.compile('|'.join(self.injection_phrases + self.inappropriate_patterns), re.IGNORECASE)
+
 
         self.email_regex = re.compile(r"[a-zA-Z0-9_.+\-]+@[a-zA-Z0-9\-]+\.[a-zA-Z0-9\-.]+")
         self.phone_regex = re.compile(r"(?:\+?66|0)[\s\-]?(?:\d[\s\-]?){8,10}")
@@ -345,6 +347,15 @@ class SecurityFilter:
                 flat.append(m)
         return list(set(flat))
 
+    def is_suspicious(self, text: str) -> bool:
+        """
+        Single-pass prescreen over the injection and inappropriate-content patterns.
+        Returns True when the text should go through the full filter_user_input check.
+        """
+        if not text:
+            return False
+        return self.suspicious_regex.search(text) is not None
+
     def sanitize_pii(self, text: str) -> str:
         """
         Redact common PII patterns from text.